@@ -1,323 +1,983 @@
-import requests, datetime, time, redis, json
+import asyncio, datetime, random, json, time, uuid
 
-from bs4 import BeautifulSoup
-from typing import Optional, Dict, List, Callable, Any, Union
+import aiohttp
+import redis.asyncio as aioredis
 
-import settings
+from typing import Optional, Dict, List, Callable, Any, Union, Awaitable, Iterator, Tuple
+
+import eta, events, extractor, history, leader, metrics, settings
+from snapshot import FORMAT_DT, BoardSnapshot, MachineState, Transition, cabinet_dt, diff, empty_snapshot, parse_upd_ts
 from logger import setup_logger, log_function
 
 # Create logger for Usys
 logger = setup_logger('Usys')
 
+FETCH_TIME = metrics.Histogram('unimeter_fetch_seconds', 'Upstream page fetch time.', ('site',))
+FETCH_RESPONSES = metrics.Counter('unimeter_fetch_total', 'Upstream fetches by HTTP status.', ('site', 'status'))
+MACHINES_CHANGED = metrics.Histogram('unimeter_machines_changed', 'Machines changed per poll cycle.', ('site',),
+                                     buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+FETCH_RETRIES = metrics.Counter('unimeter_fetch_retries_total', 'Upstream requests retried after a failure.', ('site',))
+BREAKER_OPEN = metrics.Gauge('unimeter_breaker_open', 'Whether polling of a site is paused after repeated failures.',
+                             ('site',))
+REDIS_RTT = metrics.Histogram('redis_command_seconds', 'Redis round-trip time per command.', ('command',))
+
+
+class _TimedPipeline(aioredis.client.Pipeline):
+    """Pipeline that records the round trip of the whole batch."""
+
+    async def execute(self, raise_on_error: bool = True) -> List[Any]:
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_RTT.observe(time.perf_counter() - start, "TRANSACTION" if self.is_transaction else "PIPELINE")
+
+
+class _TimedRedis(aioredis.Redis):
+    """Redis client that records the round trip of every command."""
+
+    async def execute_command(self, *args, **options) -> Any:
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_RTT.observe(time.perf_counter() - start, str(args[0]))
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> _TimedPipeline:
+        return _TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+_redis_pool: Optional[aioredis.ConnectionPool] = None
+
+
+def redis_client() -> aioredis.Redis:
+    """Async Redis client on the process-wide connection pool, created on first use."""
+    global _redis_pool
+    if _redis_pool is None:
+        # A burst waits for a free connection instead of failing with "Too many connections"
+        _redis_pool = aioredis.BlockingConnectionPool(
+            max_connections=settings.REDIS_POOL_SIZE, timeout=settings.REDIS_POOL_TIMEOUT, **settings.REDIS_DB,
+        )
+        logger.info(f"Created Redis connection pool of {settings.REDIS_POOL_SIZE} connections")
+    return _TimedRedis(connection_pool=_redis_pool)
+
+
+async def close_redis() -> None:
+    """Disconnect the shared Redis pool."""
+    global _redis_pool
+    if _redis_pool is not None:
+        await _redis_pool.disconnect()
+        _redis_pool = None
+
+
+class Site:
+    """A single laundry (UniMetriq cabinet) served by the bot."""
+
+    __slots__ = ("site_id", "url", "title")
+
+    def __init__(self, site_id: str, url: str, title: str = ""):
+        if not site_id or not site_id.replace("-", "").isalnum():
+            raise ValueError(f"Invalid site id {site_id!r}: only letters, digits and '-' are allowed")
+        self.site_id: str = site_id
+        self.url: str = url
+        self.title: str = title or site_id
+
+    def __repr__(self) -> str:
+        return f"Site({self.site_id!r})"
+
+
+def load_sites(config: Optional[Dict[str, Any]] = None) -> List[Site]:
+    """Build the list of sites from ``settings.SITES`` (site id -> url or {url, title})."""
+    config = settings.SITES if config is None else config
+    sites = []
+    for site_id, value in config.items():
+        if isinstance(value, str):
+            value = {"url": value}
+        sites.append(Site(site_id, value["url"], value.get("title", "")))
+    if not sites:
+        raise ValueError("No sites configured")
+    return sites
+
+
+@log_function(logger)
+async def migrate_legacy_keys(redis_db: aioredis.Redis, site_id: str) -> None:
+    """Move keys written before multi-site support (``wash_data``, ``wash_alarmer:<n>``) under ``site_id``."""
+    if await redis_db.exists('wash_data'):
+        await redis_db.renamenx('wash_data', WashMachRedis.LEGACY_LIST.format(site_id))
+        logger.info(f"Migrated legacy wash_data to site {site_id}")
+    async for key in redis_db.scan_iter(match='wash_alarmer:*'):
+        suffix = key.decode("utf-8").split(':', 1)[1]
+        if suffix.isdigit():
+            await redis_db.renamenx(key, RedisUser.name_db(site_id, int(suffix)))
+            logger.info(f"Migrated legacy subscribers of machine #{int(suffix) + 1} to site {site_id}")
+
+
+@log_function(logger)
+async def migrate_schema(redis_db: aioredis.Redis, site_ids: List[str]) -> None:
+    """Convert per-site JSON lists (``wash_data:<site>``) into packed hashes, once."""
+    version = int(await redis_db.get(WashMachRedis.SCHEMA_KEY) or 1)
+    if version >= WashMachRedis.SCHEMA_VERSION:
+        return
+    for site_id in site_ids:
+        old_key = WashMachRedis.LEGACY_LIST.format(site_id)
+
+        async def move(pipe: aioredis.client.Pipeline) -> None:
+            rows = [json.loads(row) for row in await pipe.lrange(old_key, 0, -1)]
+            pipe.multi()
+            if rows:
+                pipe.hset(WashMachRedis.name_for(site_id), mapping={
+                    row['num']: WashMachRedis.pack(
+                        row['status'],
+                        parse_upd_ts(row['upd_dt'])
+                    ) for row in rows
+                })
+                pipe.delete(old_key)
+
+        await redis_db.transaction(move, old_key)
+        logger.info(f"Migrated {old_key} to schema v{WashMachRedis.SCHEMA_VERSION}")
+    await redis_db.set(WashMachRedis.SCHEMA_KEY, WashMachRedis.SCHEMA_VERSION)
+
 
 class WashMachRedis:
-    """Class for handling washing machine data in Redis."""
+    """Washing machine board of one site, stored as a Redis hash of packed ``status:epoch`` fields."""
+
+    SCHEMA_KEY = 'wash_board:schema_version'
+    SCHEMA_VERSION = 2
+    LEGACY_LIST = 'wash_data:{}'
     
-    def __init__(self, redis_db: redis.StrictRedis):
+    def __init__(self, redis_db: aioredis.Redis, site_id: str, lease: Optional[leader.LeaderLease] = None):
         self.redis_db = redis_db
-        self.initialize_data()
+        self.site_id = site_id
+        self.lease = lease
+
+    @staticmethod
+    def name_for(site_id: str) -> str:
+        return f'wash_board:{site_id}'
 
     @property
     def name_db(self) -> str:
-        return 'wash_data'
+        return self.name_for(self.site_id)
+
+    @staticmethod
+    def pack(status: bool, upd_ts: int) -> str:
+        return f"{int(status)}:{upd_ts}"
+
+    @staticmethod
+    def unpack(value: bytes) -> Tuple[bool, int]:
+        status, upd_ts = value.split(b":", 1)
+        return status == b"1", int(upd_ts)
+
+    @property
+    def version_key(self) -> str:
+        return f'{self.name_db}:version'
+
+    @property
+    def fetched_key(self) -> str:
+        """Epoch of the last successful fetch of the board, changed or not."""
+        return f'{self.name_db}:fetched'
+
+    # Number of results ``queue_load`` adds to a pipeline
+    LOAD_RESULTS = 3
+
+    def queue_load(self, pipe: aioredis.client.Pipeline) -> None:
+        """Queue the reads of the board, its version and fetch time; ``parse_snapshot`` takes the results."""
+        pipe.hgetall(self.name_db)
+        pipe.get(self.version_key)
+        pipe.get(self.fetched_key)
 
     @log_function(logger)
-    def initialize_data(self) -> None:
-        """Initialize Redis with default washing machine data if it doesn't exist."""
-        if not self.redis_db.exists(self.name_db):
-            initial_data = [
-                json.dumps(
-                    dict(
-                        num=i,
-                        status=False,
-                        upd_dt=datetime.datetime.now().strftime("%d.%m.%Y в %H:%M")
-                    ),
-                    ensure_ascii=True,
-                    indent=4
-                ) for i in range(1, 7)
-            ]
-            # Add data in reverse order to maintain correct indexing
-            self.redis_db.lpush(self.name_db, *sorted(initial_data, reverse=True))
+    async def load_snapshot(self) -> BoardSnapshot:
+        """Read the whole board, its version and fetch time in one round trip."""
+        async with self.redis_db.pipeline(transaction=False) as pipe:
+            self.queue_load(pipe)
+            results = await pipe.execute()
+        return self.parse_snapshot(*results)
+
+    def parse_snapshot(self, data: Dict[bytes, bytes], version: Optional[bytes],
+                       fetched: Optional[bytes] = None) -> BoardSnapshot:
+        machines = {}
+        for num, value in data.items():
+            status, upd_ts = self.unpack(value)
+            machines[int(num)] = MachineState(int(num), status, upd_ts)
+        return BoardSnapshot(self.site_id, int(version or 0), machines, float(fetched) if fetched else None)
+
+    async def _fence(self, pipe: aioredis.client.Pipeline) -> None:
+        """Start the transaction of ``pipe``, refusing to if the leader lease is not ours.
+
+        The lease is checked under WATCH, so a lease lost in between aborts the write with ``WatchError``.
+        """
+        if self.lease is not None:
+            await pipe.watch(leader.LEADER_KEY)
+            if not self.lease.holds(await pipe.get(leader.LEADER_KEY)):
+                raise leader.LeaseLost(f"Not the leader, refusing to write the board of site {self.site_id}")
+        pipe.multi()
 
     @log_function(logger)
-    def get_by_num(self, num: int) -> Dict[str, Any]:
-        """Get washing machine data by number."""
-        return json.loads(self.redis_db.lindex(self.name_db, num-1))
+    async def mark_fetched(self, fetched_at: float) -> None:
+        """Record a successful fetch that did not change the board.
+
+        Fenced like ``commit``: a deposed leader must not keep a stale board looking fresh.
+        """
+        async with self.redis_db.pipeline(transaction=True) as pipe:
+            await self._fence(pipe)
+            pipe.set(self.fetched_key, int(fetched_at))
+            await pipe.execute()
+
+    @log_function(logger)
+    async def commit(self, snapshot: BoardSnapshot, changed: List[MachineState], transitions: List[Transition]) -> None:
+        """Write changed machines, the new version, the transition events and their history atomically.
+
+        With a leader lease, the transaction only goes through while the lease is ours (see ``_fence``).
+        """
+        async with self.redis_db.pipeline(transaction=True) as pipe:
+            await self._fence(pipe)
+            pipe.hset(self.name_db, mapping={state.num: self.pack(state.status, state.upd_ts) for state in changed})
+            pipe.set(self.version_key, snapshot.version)
+            if snapshot.fetched_at is not None:
+                pipe.set(self.fetched_key, int(snapshot.fetched_at))
+            events.publish(pipe, transitions)
+            events.announce(pipe, self.site_id, snapshot.version)
+            history.record(pipe, transitions)
+            await pipe.execute()
 
     @log_function(logger)
-    def write_by_num(self, num: int, data: Dict[str, Any]) -> None:
-        """Update washing machine data by number."""
-        self.redis_db.lset(self.name_db, num-1, json.dumps(data, ensure_ascii=True, indent=4))
+    async def get_by_num(self, num: int) -> Optional[Tuple[bool, int]]:
+        """Get washing machine data by number."""
+        value = await self.redis_db.hget(self.name_db, num)
+        return self.unpack(value) if value is not None else None
 
 
 class WashMach:
     """Class representing a washing machine."""
     
-    FORMAT_DT = "%d.%m.%Y в %H:%M"
+    FORMAT_DT = FORMAT_DT
     
-    def __init__(self, num: int, status: bool, upd_dt: str = "26.01.2024 в 14:49", redis_db: Optional[redis.StrictRedis] = None):
+    def __init__(self, num: int, status: bool, upd_dt: str = "26.01.2024 в 14:49",
+                 store: Optional[WashMachRedis] = None):
         self.num: int = num
         self.status: bool = status
-        self.upd_dt: datetime.datetime = datetime.datetime.strptime(upd_dt, self.FORMAT_DT)
-        self.alert_func: Callable = lambda num, status, old_status, upd_dt, old_upd_dt: print(f"№{num} wash Mach — {'Занято' if status else 'СВОБОДНО'}")
-        self._redis = None
-        if redis_db:
-            self._redis = WashMachRedis(redis_db)
+        self.upd_dt: datetime.datetime = cabinet_dt(parse_upd_ts(upd_dt))
+        self._redis = store
         logger.info(f"Initialized WashMach #{num} with status {status}")
 
     @log_function(logger)
-    def compare(self, num: int, status: bool, upd_dt: str) -> None:
-        """Compare current status with new status and update if needed."""
-        dt = self.upd_dt.timestamp()
-        new_dt = datetime.datetime.strptime(upd_dt, self.FORMAT_DT).timestamp()
-        
-        if abs(new_dt - dt) > 0 and self.num == num:
-            old_status = self.status
-            self.status = status
-            
-            if old_status != status:
-                old_upd_dt = self.upd_dt
-                self.upd_dt = datetime.datetime.strptime(upd_dt, self.FORMAT_DT)
-                
-                if self._redis:
-                    self._redis.write_by_num(num, self.get_info(from_redis=False))
-                
-                self.alert_func(num, status, old_status, upd_dt, old_upd_dt)
-                logger.info(f"WashMach #{num} status changed from {old_status} to {status}")
-
-    @log_function(logger)
-    def _fill_from_db(self) -> None:
+    async def _fill_from_db(self) -> None:
         """Refresh data from Redis."""
         if self._redis:
-            data = self._redis.get_by_num(self.num)
-            self.status = data['status']
-            self.upd_dt = datetime.datetime.strptime(data['upd_dt'], self.FORMAT_DT)
+            data = await self._redis.get_by_num(self.num)
+            if data is not None:
+                self.set_state(*data)
+
+    def set_state(self, status: bool, upd_ts: int) -> None:
+        """Set state from stored values."""
+        self.status = status
+        self.upd_dt = cabinet_dt(upd_ts)
 
     @log_function(logger)
-    def get_info(self, from_redis: bool = True) -> Dict[str, Any]:
+    async def get_info(self, from_redis: bool = True) -> Dict[str, Any]:
         """Get washing machine info, optionally refreshing from Redis first."""
         if from_redis:
-            self._fill_from_db()
+            await self._fill_from_db()
         return {
             "num": self.num,
             "status": self.status,
             "upd_dt": self.upd_dt.strftime(self.FORMAT_DT)
         }
 
-    def to_string(self, date: bool = True) -> str:
-        """Create string representation of washing machine status."""
+    def to_string(self, date: bool = True, eta_ts: Optional[int] = None) -> str:
+        """Create string representation of washing machine status, with the expected end of a busy one."""
         status_text = "‼️BUSY‼️" if self.status else "✅Free"
-        date_info = f'\nДата обновления: {self.upd_dt}' if date else ""
-        return f'🧻№{self.num}  - {status_text}{date_info}'
+        eta_info = f' ⏳ {eta.describe(eta_ts)}' if self.status and eta_ts is not None else ""
+        date_info = f'\nДата обновления: {self.upd_dt:%Y-%m-%d %H:%M:%S}' if date else ""
+        return f'🧻№{self.num}  - {status_text}{eta_info}{date_info}'
+
+
+HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Encoding': 'gzip, deflate',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'cross-site',
+    'Sec-Fetch-User': '?1',
+    'Upgrade-Insecure-Requests': '1',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+}
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    """Create the pooled HTTP session used to talk to UniMetriq. Must be called inside a running loop."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=settings.UPSTREAM_POOL_SIZE,
+            limit_per_host=settings.UPSTREAM_PER_HOST_LIMIT,
+            keepalive_timeout=settings.UPSTREAM_KEEPALIVE,
+            ssl=False,
+        ),
+        timeout=aiohttp.ClientTimeout(
+            total=settings.UPSTREAM_TIMEOUT,
+            sock_connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+            sock_read=settings.UPSTREAM_READ_TIMEOUT,
+        ),
+        headers=HEADERS,
+    )
+
+
+class UpstreamError(Exception):
+    """Raised when the cabinet answers with a server error."""
+
+
+class CircuitBreaker:
+    """Stops polling a site whose fetches keep failing.
+
+    After ``failures`` failed fetches in a row the breaker opens for ``cooldown`` seconds. The first
+    fetch after that is a trial: success closes the breaker, failure opens it again for twice as
+    long, up to ``max_cooldown``.
+    """
+
+    def __init__(self, failures: int = settings.UPSTREAM_BREAKER_FAILURES,
+                 cooldown: float = settings.UPSTREAM_BREAKER_COOLDOWN,
+                 max_cooldown: float = settings.UPSTREAM_BREAKER_MAX_COOLDOWN):
+        self.threshold = failures
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.cooldown = cooldown
+        self.open_until = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def allow(self) -> bool:
+        """Whether a fetch may go out now."""
+        return not self.is_open or time.monotonic() >= self.open_until
+
+    def success(self) -> None:
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures > self.threshold:
+            # A failed trial
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+        if self.is_open:
+            self.open_until = time.monotonic() + self.cooldown
 
 
 class UniMeter:
-    """Class for fetching and processing washing machine data."""
+    """Class for fetching and processing washing machine data of a single site."""
     
-    def __init__(self, redis_db: Optional[redis.StrictRedis] = None, server_mode: bool = False):
+    def __init__(self, site: Site, redis_db: Optional[aioredis.Redis] = None, server_mode: bool = False,
+                 session_factory: Optional[Callable[[], Awaitable[aiohttp.ClientSession]]] = None,
+                 lease: Optional[leader.LeaderLease] = None):
+        self.site = site
         self._server_mode = server_mode
-        self.ses = requests.Session()
-        self.headers = {
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'cross-site',
-            'Sec-Fetch-User': '?1',
-            'Upgrade-Insecure-Requests': '1',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_factory = session_factory
         self._redis = redis_db
-        self.arr_washes: List[WashMach] = [WashMach(i, False, redis_db=self._redis) for i in range(1, 7)]
-        logger.info("Initialized UniMeter with 6 washing machines")
-        self.getData()
+        self._store: Optional[WashMachRedis] = WashMachRedis(redis_db, site.site_id, lease) if redis_db else None
+        self.snapshot: BoardSnapshot = empty_snapshot(site.site_id)
+        self._warm_started: bool = False
+        self.last_parse_time: Optional[float] = None
+        # Conditional fetching state: validators sent back to the upstream and hash of the last processed board
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._last_digest: Optional[str] = None
+        self.breaker = CircuitBreaker()
+        self.total_cycles: int = 0
+        self.skipped_cycles: int = 0
+        self.arr_washes: List[WashMach] = []
+        logger.info(f"Initialized UniMeter for site {site.site_id} with {len(self.arr_washes)} washing machines")
 
-    @log_function(logger)
-    def _fetch_from_website(self) -> List[WashMach]:
-        """Fetch washing machine data from UniMeter website."""
-        logger.info("Fetching data from UniMeter website")
+    def _ensure_machines(self, count: int) -> None:
+        """Grow ``arr_washes`` to ``count`` machines as they are discovered on the site."""
+        if count <= len(self.arr_washes):
+            return
+        for num in range(len(self.arr_washes) + 1, count + 1):
+            self.arr_washes.append(WashMach(num, False, store=self._store))
+        logger.info(f"Site {self.site.site_id} now has {count} washing machines")
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, or a private one created on first use."""
+        if self._session_factory:
+            return await self._session_factory()
+        if self._session is None or self._session.closed:
+            self._session = create_http_session()
+        return self._session
+
+    async def close(self) -> None:
+        """Close the private HTTP session, if any."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, session: aiohttp.ClientSession,
+                       headers: Dict[str, str]) -> Tuple[int, bytes, str, Any]:
+        """GET the site page as ``(status, body, encoding, headers)``.
+
+        Connection errors, timeouts and 5xx answers are retried ``UPSTREAM_RETRIES`` times with
+        jittered exponential backoff, then raised.
+        """
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                async with session.get(self.site.url, headers=headers) as response:
+                    FETCH_RESPONSES.inc(self.site.site_id, str(response.status))
+                    if response.status >= 500:
+                        raise UpstreamError(f"HTTP {response.status}")
+                    content = await response.read() if response.status != 304 else b""
+                    return response.status, content, response.charset or "utf-8", response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamError) as e:
+                if not isinstance(e, UpstreamError):
+                    FETCH_RESPONSES.inc(self.site.site_id, "error")
+                if attempt >= settings.UPSTREAM_RETRIES:
+                    raise
+                delay = settings.UPSTREAM_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                attempt += 1
+                FETCH_RETRIES.inc(self.site.site_id)
+                logger.warning(f"Fetch of site {self.site.site_id} failed ({type(e).__name__}: {e}), "
+                               f"retry {attempt} in {delay:.1f}s")
+            finally:
+                FETCH_TIME.observe(time.perf_counter() - start, self.site.site_id)
+            await asyncio.sleep(delay)
+
+    @log_function(logger, sample=0.1)
+    async def _fetch_from_website(self) -> List[WashMach]:
+        """Fetch washing machine data from UniMeter website.
+
+        While the circuit breaker is open the site is not fetched and the last board is kept; its
+        fetch time tells readers how old it is.
+        """
+        if not self.breaker.allow():
+            logger.info(f"Site {self.site.site_id} keeps failing, not polling it for now")
+            return self.arr_washes
+        logger.info(f"Fetching data from UniMeter website for site {self.site.site_id}")
+        self.total_cycles += 1
         try:
-            response = self.ses.get(
-                "https://cabinet.unimetriq.com/client/6703b4b333805792cfa639770058bd45",
-                headers=self.headers, 
-                verify=False
-            )
-            undata = BeautifulSoup(response.content, "html.parser")
+            session = await self._get_session()
+            headers = {}
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+            try:
+                status, content, encoding, response_headers = await self._request(session, headers)
+            except Exception:
+                self._record_failure()
+                raise
+            self._record_success()
+            fetched_at = time.time()
+            if status == 304:
+                await self._mark_fetched(fetched_at)
+                return self._skip_cycle("not modified")
+            digest = extractor.fragment_digest(content)
+            if digest == self._last_digest:
+                self._save_validators(response_headers)
+                await self._mark_fetched(fetched_at)
+                return self._skip_cycle("same content hash")
+
+            board = extractor.extract_board(content, encoding)
+            self.last_parse_time = board.parse_time
+            
+            if board.upd_dt is None:
+                logger.warning(f"No update time on site {self.site.site_id}, skipping cycle")
+                return self.arr_washes
             
-            # Find all washing machine blocks
-            wash_blocks = undata.find_all("div", {"class": "col", "style": "min-width: 179px;max-width:195px;"})
+            if self._store and not self._warm_started:
+                # Start from the stored board so a restart neither rewrites it nor alerts again
+                self._apply_snapshot(await self._store.load_snapshot())
+                self._warm_started = True
             
-            for i, block in enumerate(wash_blocks):
-                if i >= len(self.arr_washes):
-                    break
-                    
-                try:
-                    self._process_machine_block(i, block, undata)
-                    time.sleep(1)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing machine block {i}: {str(e)}")
-                    continue
+            snapshot, changed, transitions = diff(
+                self.snapshot,
+                ((reading.num, reading.busy) for reading in board.machines),
+                parse_upd_ts(board.upd_dt),
+                fetched_at,
+            )
+            MACHINES_CHANGED.observe(len(changed), self.site.site_id)
+            if changed and self._store:
+                await self._store.commit(snapshot, changed, transitions)
+            elif self._store:
+                await self._store.mark_fetched(fetched_at)
+            self._apply_snapshot(snapshot)
+            
+            for transition in transitions:
+                logger.info(f"WashMach #{transition.num} on site {self.site.site_id} status changed "
+                            f"from {transition.old_status} to {transition.status}")
                 
+            # Only now: a 304 must never skip a page that was not applied (failed commit, no update time)
+            self._last_digest = digest
+            self._save_validators(response_headers)
             return self.arr_washes
             
         except Exception as e:
             logger.error(f"Error fetching data from UniMeter website: {str(e)}")
             return self.arr_washes
 
-    def _process_machine_block(self, index: int, block: Any, undata: BeautifulSoup) -> None:
-        """Process a single washing machine block from the HTML."""
-        # Check if machine is busy - explicitly look for danger
-        is_busy = "border-danger" in str(block)
-        
-        # Determine status class and border class based on what's in the block
-        if "border-danger" in str(block):
-            border_class = "border-danger"
-            status_class = "text-danger"
-        elif "border-success" in str(block):
-            border_class = "border-success"
-            status_class = "text-success"
-        else:
-            # Handle unknown status class
-            logger.warning(f"Unknown border class for machine block {index} - neither danger nor success found")
-            border_class = None
-            status_class = None
-            is_busy = False  # Default to free if unknown
-        
-        # Find the machine number
-        if border_class and status_class:
-            number_div = block.find("div", {
-                "class": lambda x: all(c in x for c in [f"{border_class}", "border", "border-3", f"{status_class}", 
-                                                        "mx-auto", "mt-3", "mb-2", "rounded-circle"]),
-                "style": lambda x: "width: 90px; height: 90px;" in x
-            })
-        else:
-            # Try a more generic approach if status classes are unknown
-            number_div = block.find("div", {
-                "class": lambda x: "rounded-circle" in x and "border" in x and "mx-auto" in x,
-                "style": lambda x: "width: 90px; height: 90px;" in x
-            })
-        
-        if not number_div:
-            logger.warning(f"Could not find number div for machine block {index}")
-            return
-            
-        number = int(number_div.text.strip())
-        
-        # Try to find status text and determine busy state
-        try:
-            # First look for specific status class if available
-            status_text = None
-            if status_class:
-                status_divs = block.find_all("div", {"class": lambda x: f"p-2 {status_class}" in x})
-                if status_divs:
-                    text_center = status_divs[-1].find("div", {"class": "text-center"})
-                    if text_center:
-                        status_text = text_center.text.strip()
-            
-            # If not found with specific class, try more generic approach
-            if not status_text:
-                status_divs = block.find_all("div", {"class": lambda x: "p-2" in x})
-                if status_divs:
-                    for div in status_divs:
-                        text_center = div.find("div", {"class": "text-center"})
-                        if text_center:
-                            status_text = text_center.text.strip()
-                            break
-            
-            # If still not found, log error and default to free
-            if not status_text:
-                logger.warning(f"Could not find status text for machine #{number} - defaulting to free")
-                is_busy = False
-            else:
-                # Determine busy state based on text content
-                is_busy = "анято" in status_text.lower()
-                logger.debug(f"Found status text for machine #{number}: '{status_text}', busy: {is_busy}")
-                
-        except Exception as e:
-            logger.error(f"Error determining status for machine #{number}: {str(e)} - defaulting to free")
-            is_busy = False
-        
-        # Get last update time
-        try:
-            update_div = undata.find("div", {"data-toggle": "tooltip", "title": lambda x: x and "Последний обмен данными" in x})
-            if not update_div:
-                logger.warning(f"Could not find update time for machine #{number}")
-                return
-                
-            update_time = update_div['title'].replace("Последний обмен данными ", "")
-            
-            logger.debug(f"Found machine #{number}: busy={is_busy}, update_time={update_time}")
-            
-            if self._redis:
-                self.arr_washes[index].get_info()
-                
-            self.arr_washes[index].compare(
-                num=number,
-                status=is_busy,
-                upd_dt=update_time
-            )
-        except Exception as e:
-            logger.error(f"Error processing update time for machine #{number}: {str(e)}")
+    def _save_validators(self, headers: Any) -> None:
+        self._etag = headers.get('ETag')
+        self._last_modified = headers.get('Last-Modified')
+
+    def _record_failure(self) -> None:
+        self.breaker.failure()
+        if self.breaker.is_open:
+            BREAKER_OPEN.set(1, self.site.site_id)
+            logger.error(f"Site {self.site.site_id} failed {self.breaker.failures} times in a row, "
+                         f"pausing polling for {self.breaker.cooldown:.0f}s")
+
+    def _record_success(self) -> None:
+        if self.breaker.is_open:
+            logger.info(f"Site {self.site.site_id} is back, resuming polling")
+        self.breaker.success()
+        BREAKER_OPEN.set(0, self.site.site_id)
 
-    def _fetch_from_redis(self) -> List[WashMach]:
+    async def _mark_fetched(self, fetched_at: float) -> None:
+        """Keep the board but note that it was confirmed at ``fetched_at``."""
+        snapshot = self.snapshot
+        self.snapshot = BoardSnapshot(snapshot.site_id, snapshot.version, snapshot.machines, fetched_at)
+        if self._store:
+            await self._store.mark_fetched(fetched_at)
+
+    def _skip_cycle(self, reason: str) -> List[WashMach]:
+        """Count a cycle in which the board did not change upstream."""
+        self.skipped_cycles += 1
+        MACHINES_CHANGED.observe(0, self.site.site_id)
+        logger.info(f"Site {self.site.site_id} unchanged ({reason}), "
+                    f"skipped {self.skipped_cycles} of {self.total_cycles} cycles")
+        return self.arr_washes
+
+    async def _fetch_from_redis(self) -> List[WashMach]:
         """Fetch washing machine data from Redis."""
-        logger.info("Fetching data from Redis")
-        for data_wash in self.arr_washes:
-            data_wash.get_info()
+        logger.info(f"Fetching data from Redis for site {self.site.site_id}")
+        await self._load_from_store()
         return self.arr_washes
 
-    @log_function(logger)
-    def getData(self) -> List[WashMach]:
+    async def _load_from_store(self) -> None:
+        """Refresh every machine of the site from Redis in a single round trip."""
+        self._apply_snapshot(await self._store.load_snapshot())
+
+    async def prepare(self) -> None:
+        """Load the stored board in read mode, so machines are known before the first request.
+
+        In server mode the next fetch starts over from the stored board, which another leader may
+        have written since this replica last polled.
+        """
+        if self._store and not self._server_mode:
+            await self._load_from_store()
+            logger.info(f"Loaded {len(self.arr_washes)} washing machines of site {self.site.site_id}")
+        elif self._server_mode:
+            self._warm_started = False
+            self._etag = self._last_modified = self._last_digest = None
+
+    def _apply_snapshot(self, snapshot: BoardSnapshot) -> None:
+        """Make ``snapshot`` current and update the machine objects from it."""
+        self.snapshot = snapshot
+        self._ensure_machines(max(snapshot.machines, default=0))
+        for state in snapshot:
+            self.arr_washes[state.num - 1].set_state(state.status, state.upd_ts)
+
+    @log_function(logger, sample=0.1)
+    async def getData(self) -> List[WashMach]:
         """Get washing machine data from appropriate source."""
         if not self._redis or self._server_mode:
-            return self._fetch_from_website()
+            return await self._fetch_from_website()
         else:
-            return self._fetch_from_redis()
+            return await self._fetch_from_redis()
+
+
+class SiteRegistry:
+    """All configured sites, fetched concurrently over one pooled HTTP session."""
+
+    def __init__(self, redis_db: Optional[aioredis.Redis] = None, server_mode: bool = False,
+                 sites: Optional[List[Site]] = None, lease: Optional[leader.LeaderLease] = None):
+        sites = load_sites() if sites is None else sites
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._redis = redis_db
+        self._server_mode = server_mode
+        self.meters: Dict[str, UniMeter] = {
+            site.site_id: UniMeter(site, redis_db, server_mode, session_factory=self._get_session, lease=lease)
+            for site in sites
+        }
+        # Monotonic start of the poll cycle in progress, None between cycles
+        self.cycle_started: Optional[float] = None
+
+    def __iter__(self) -> Iterator[UniMeter]:
+        return iter(self.meters.values())
+
+    def __len__(self) -> int:
+        return len(self.meters)
+
+    def get(self, site_id: str) -> Optional[UniMeter]:
+        return self.meters.get(site_id)
+
+    @property
+    def default(self) -> UniMeter:
+        """The first configured site."""
+        return next(iter(self.meters.values()))
+
+    async def prepare(self) -> None:
+        """Migrate stored data and load the boards; run once at startup, inside the event loop."""
+        if self._redis:
+            await migrate_legacy_keys(self._redis, self.default.site.site_id)
+            await migrate_schema(self._redis, list(self.meters))
+        await asyncio.gather(*(meter.prepare() for meter in self.meters.values()))
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = create_http_session()
+        return self._session
+
+    async def close(self) -> None:
+        """Close the shared HTTP session."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def getData(self) -> Dict[str, List[WashMach]]:
+        """Get data of every site concurrently; keys follow the configuration order.
+
+        In read mode all boards come from Redis in a single round trip.
+        """
+        if self._redis and not self._server_mode:
+            await self._load_from_store()
+            return {site_id: meter.arr_washes for site_id, meter in self.meters.items()}
+        results = await asyncio.gather(*(meter.getData() for meter in self.meters.values()))
+        return dict(zip(self.meters, results))
+
+    async def _load_from_store(self) -> None:
+        meters = list(self.meters.values())
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for meter in meters:
+                meter._store.queue_load(pipe)
+            results = await pipe.execute()
+        for i, meter in enumerate(meters):
+            step = WashMachRedis.LOAD_RESULTS
+            meter._apply_snapshot(meter._store.parse_snapshot(*results[step * i:step * (i + 1)]))
+
+    async def run_forever(self, interval: float, scheduler: Optional[Any] = None) -> None:
+        """Poll all sites until the task is cancelled.
+
+        Waits ``interval`` seconds between polls, or as long as ``scheduler.next_interval`` decides.
+        """
+        logger.info(f"Starting polling of {len(self.meters)} site(s)"
+                    + (" with adaptive scheduling" if scheduler else f" every {interval}s"))
+        while True:
+            delay = interval
+            self.cycle_started = time.monotonic()
+            try:
+                await self.getData()
+                if scheduler is not None:
+                    delay = await scheduler.next_interval(self)
+            except Exception as e:
+                logger.error(f"Error in polling cycle: {str(e)}")
+            finally:
+                self.cycle_started = None
+            await asyncio.sleep(delay)
+
+    def poll_healthy(self) -> bool:
+        """False once a poll cycle has been running for longer than ``LEADER_POLL_TIMEOUT``."""
+        return self.cycle_started is None or time.monotonic() - self.cycle_started < settings.LEADER_POLL_TIMEOUT
 
 
 class RedisUser:
-    """Class for managing user data in Redis."""
+    """Class for managing user data in Redis.
+
+    Subscribers of a machine live in ``wash_alarmer:<site>:<n>`` and every user has the reverse
+    set ``wash_user:<user>`` of ``<site>:<n>`` members, so a user's subscriptions are one read
+    away. Both sides are always changed together in a transaction or a Lua script.
+    """
+
+    INDEX_FLAG = 'wash_user:indexed'
+
+    # KEYS: forward set, claim set; ARGV: reverse key prefix, member, claim ttl.
+    # Moves all subscribers into the claim set and returns it; a second call with the same claim
+    # set returns the same users without popping anything new.
+    POP_SCRIPT = """
+        if redis.call('EXISTS', KEYS[2]) == 0 then
+            local users = redis.call('SMEMBERS', KEYS[1])
+            if #users == 0 then return {} end
+            for i = 1, #users, 5000 do
+                redis.call('SADD', KEYS[2], unpack(users, i, math.min(i + 4999, #users)))
+            end
+            redis.call('EXPIRE', KEYS[2], ARGV[3])
+            redis.call('DEL', KEYS[1])
+            for _, user in ipairs(users) do
+                redis.call('SREM', ARGV[1] .. user, ARGV[2])
+            end
+        end
+        return redis.call('SMEMBERS', KEYS[2])
+    """
+
+    # KEYS: reverse set; ARGV: forward key prefix, user id. Returns the removed members.
+    CLEAR_SCRIPT = """
+        local machines = redis.call('SMEMBERS', KEYS[1])
+        for _, machine in ipairs(machines) do
+            redis.call('SREM', ARGV[1] .. machine, ARGV[2])
+        end
+        redis.call('DEL', KEYS[1])
+        return machines
+    """
     
-    def __init__(self, redis_db: redis.StrictRedis):
+    def __init__(self, redis_db: aioredis.Redis):
         self.redis_db = redis_db
+        self._pop = redis_db.register_script(self.POP_SCRIPT)
+        self._clear = redis_db.register_script(self.CLEAR_SCRIPT)
+
+    @staticmethod
+    def name_db(site_id: str, num: int) -> str:
+        """Get Redis key for wash alarmer by site and machine index."""
+        return f'wash_alarmer:{site_id}:{num}'
+
+    @staticmethod
+    def user_db(user_id: str) -> str:
+        """Get Redis key of the machines a user is subscribed to."""
+        return f'wash_user:{user_id}'
+
+    @staticmethod
+    def member(site_id: str, num: int) -> str:
+        return f'{site_id}:{num}'
+
+    @staticmethod
+    def parse_member(member: bytes) -> Tuple[str, int]:
+        site_id, num = member.decode("utf-8").rsplit(':', 1)
+        return site_id, int(num)
 
-    def name_db(self, num: int) -> str:
-        """Get Redis key for wash alarmer by machine number."""
-        return f'wash_alarmer:{num}'
+    @log_function(logger)
+    async def build_reverse_index(self) -> None:
+        """Fill the reverse index from the subscriber sets once, for data written before it existed.
+
+        Call at startup, after the legacy keys have been migrated by ``SiteRegistry.prepare``.
+        """
+        if await self.redis_db.exists(self.INDEX_FLAG):
+            return
+        async for key in self.redis_db.scan_iter(match='wash_alarmer:*:*'):
+            _, site_id, num = key.decode("utf-8").split(':')
+            users = await self.redis_db.smembers(key)
+            async with self.redis_db.pipeline(transaction=False) as pipe:
+                for user_id in users:
+                    pipe.sadd(self.user_db(user_id.decode("utf-8")), self.member(site_id, int(num)))
+                await pipe.execute()
+        # Only once complete: a scan cut short is simply run again, SADD is idempotent
+        await self.redis_db.set(self.INDEX_FLAG, 1)
+        logger.info("Built reverse subscription index")
 
-    def clear_by_num(self, num: int) -> None:
+    async def clear_by_num(self, site_id: str, num: int) -> None:
         """Clear all users for a specific washing machine."""
-        self.redis_db.delete(self.name_db(num))
+        await self.pop_by_num(site_id, num)
 
-    def add_user_data(self, user_id: str) -> None:
+    async def add_user_data(self, user_id: str) -> None:
         """Increment user counter."""
-        name = f"user:{user_id}"
-        value = 0
-        if self.redis_db.exists(name):
-            value = int(self.redis_db.get(name).decode("utf-8"))
-        self.redis_db.set(name, value=value+1)
+        await self.redis_db.incr(f"user:{user_id}")
 
-    def add_by_num(self, num: int, user_id: str) -> None:
+    async def add_by_num(self, site_id: str, num: int, user_id: str) -> None:
         """Add user to a washing machine's notification list."""
-        self.redis_db.sadd(self.name_db(num), user_id)
+        async with self.redis_db.pipeline(transaction=True) as pipe:
+            pipe.sadd(self.name_db(site_id, num), user_id)
+            pipe.sadd(self.user_db(user_id), self.member(site_id, num))
+            await pipe.execute()
 
-    def remove_by_num(self, num: int, user_id: str) -> None:
+    async def remove_by_num(self, site_id: str, num: int, user_id: str) -> None:
         """Remove user from a washing machine's notification list."""
-        self.redis_db.srem(self.name_db(num), user_id)
+        async with self.redis_db.pipeline(transaction=True) as pipe:
+            pipe.srem(self.name_db(site_id, num), user_id)
+            pipe.srem(self.user_db(user_id), self.member(site_id, num))
+            await pipe.execute()
 
-    def get_by_num(self, num: int) -> List[str]:
+    async def get_by_num(self, site_id: str, num: int) -> List[str]:
         """Get all users for a washing machine."""
-        data = self.redis_db.smembers(self.name_db(num))
+        data = await self.redis_db.smembers(self.name_db(site_id, num))
         return [x.decode("utf-8") for x in data]
 
-    def pop_by_num(self, num: int) -> List[str]:
-        """Pop all users from a washing machine's notification list."""
-        result = []
-        while True:
-            popped_element = self.redis_db.spop(self.name_db(num))
-            if popped_element is None:
-                break
-            result.append(popped_element.decode("utf-8"))
-        return result
\ No newline at end of file
+    async def count_many(self, machines: List[Tuple[str, int]]) -> List[int]:
+        """Number of subscribers of each ``(site, machine index)`` in one round trip."""
+        async with self.redis_db.pipeline(transaction=False) as pipe:
+            for site_id, num in machines:
+                pipe.scard(self.name_db(site_id, num))
+            return await pipe.execute()
+
+    async def get_by_user(self, user_id: str) -> List[Tuple[str, int]]:
+        """All ``(site, machine index)`` the user is subscribed to."""
+        return [self.parse_member(member) for member in await self.redis_db.smembers(self.user_db(user_id))]
+
+    async def is_subscribed_many(self, user_id: str, machines: List[Tuple[str, int]]) -> List[bool]:
+        """Membership of the user in each ``(site, machine index)`` with a single SMISMEMBER."""
+        if not machines:
+            return []
+        result = await self.redis_db.smismember(self.user_db(user_id), [self.member(*machine) for machine in machines])
+        return [bool(item) for item in result]
+
+    async def clear_user(self, user_id: str) -> List[Tuple[str, int]]:
+        """Remove every subscription of the user atomically; returns what was removed."""
+        removed = await self._clear(keys=[self.user_db(user_id)], args=['wash_alarmer:', user_id])
+        return [self.parse_member(member) for member in removed]
+
+    async def pop_by_num(self, site_id: str, num: int, claim_id: Optional[str] = None) -> List[str]:
+        """Pop all users from a washing machine's notification list in one atomic step.
+
+        With ``claim_id`` the users are kept in a claim set until ``release_claim``, and popping again
+        with the same id (e.g. when an event is redelivered after a crash) returns the same users.
+        """
+        claim_key = f'wash_claim:{claim_id or uuid.uuid4().hex}:{site_id}:{num}'
+        users = await self._pop(
+            keys=[self.name_db(site_id, num), claim_key],
+            args=['wash_user:', self.member(site_id, num), settings.CLAIM_TTL],
+        )
+        if claim_id is None:
+            await self.redis_db.delete(claim_key)
+        return [x.decode("utf-8") for x in users]
+
+    async def release_claim(self, claim_id: str, site_id: str, num: int) -> None:
+        """Forget users claimed by ``pop_by_num`` once they have been notified."""
+        await self.redis_db.delete(f'wash_claim:{claim_id}:{site_id}:{num}')
+
+
+class WaitQueue:
+    """"Any free machine" waiters of a site, woken one per freed machine in arrival order.
+
+    Waiters are a sorted set scored by arrival time (``wash_wait:<site>``). A freed machine is
+    offered to the head waiter only: the offer is kept in ``wash_offer:<site>`` (machine -> user)
+    with its deadline in ``wash_offer:<site>:due`` and the waiter's arrival time in
+    ``wash_offer:<site>:arrived``. If the user does not claim the machine before the deadline and it
+    is still free, ``sweep`` offers it to the next waiter. If somebody else takes the machine first,
+    ``resolve`` puts the user back in the queue at their old place.
+    """
+
+    # KEYS: queue, offers, deadlines, arrivals; ARGV: machine, deadline. Returns the woken user, or
+    # nil when nobody waits or the machine is already on offer.
+    WAKE_SCRIPT = """
+        if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1 then return false end
+        local head = redis.call('ZPOPMIN', KEYS[1])
+        if #head == 0 then return false end
+        redis.call('HSET', KEYS[2], ARGV[1], head[1])
+        redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+        redis.call('HSET', KEYS[4], ARGV[1], head[2])
+        return head[1]
+    """
+
+    # KEYS: offers, deadlines, arrivals; ARGV: machine, user. Returns 1 if the offer was still the user's.
+    CLAIM_SCRIPT = """
+        if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then return 0 end
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        redis.call('ZREM', KEYS[2], ARGV[1])
+        redis.call('HDEL', KEYS[3], ARGV[1])
+        return 1
+    """
+
+    # KEYS: queue, offers, deadlines, arrivals; ARGV: machine. Drops the offer of a machine that
+    # became busy; an offer still unclaimed means somebody else took the machine, and its user
+    # goes back to the queue with the original arrival time. Returns that user, or nil.
+    RESOLVE_SCRIPT = """
+        local user = redis.call('HGET', KEYS[2], ARGV[1])
+        local arrived = redis.call('HGET', KEYS[4], ARGV[1])
+        redis.call('HDEL', KEYS[2], ARGV[1])
+        redis.call('ZREM', KEYS[3], ARGV[1])
+        redis.call('HDEL', KEYS[4], ARGV[1])
+        if not user then return false end
+        redis.call('ZADD', KEYS[1], 'NX', arrived or 0, user)
+        return user
+    """
+
+    # KEYS: queue, offers, deadlines, arrivals, board; ARGV: now, next deadline, oldest arrival to
+    # keep. Passes every expired offer of a machine that is still free to the next waiter.
+    # Returns a flat list of machine, user pairs that were offered.
+    SWEEP_SCRIPT = """
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[3])
+        local offered = {}
+        for _, num in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])) do
+            redis.call('HDEL', KEYS[2], num)
+            redis.call('ZREM', KEYS[3], num)
+            redis.call('HDEL', KEYS[4], num)
+            local state = redis.call('HGET', KEYS[5], num)
+            if state and string.sub(state, 1, 1) == '0' then
+                local head = redis.call('ZPOPMIN', KEYS[1])
+                if #head > 0 then
+                    redis.call('HSET', KEYS[2], num, head[1])
+                    redis.call('ZADD', KEYS[3], ARGV[2], num)
+                    redis.call('HSET', KEYS[4], num, head[2])
+                    table.insert(offered, num)
+                    table.insert(offered, head[1])
+                end
+            end
+        end
+        return offered
+    """
+
+    def __init__(self, redis_db: aioredis.Redis):
+        self.redis_db = redis_db
+        self._wake = redis_db.register_script(self.WAKE_SCRIPT)
+        self._claim = redis_db.register_script(self.CLAIM_SCRIPT)
+        self._resolve = redis_db.register_script(self.RESOLVE_SCRIPT)
+        self._sweep = redis_db.register_script(self.SWEEP_SCRIPT)
+
+    @staticmethod
+    def queue_key(site_id: str) -> str:
+        return f'wash_wait:{site_id}'
+
+    @staticmethod
+    def offers_key(site_id: str) -> str:
+        return f'wash_offer:{site_id}'
+
+    @staticmethod
+    def due_key(site_id: str) -> str:
+        return f'wash_offer:{site_id}:due'
+
+    @staticmethod
+    def arrived_key(site_id: str) -> str:
+        return f'wash_offer:{site_id}:arrived'
+
+    def _keys(self, site_id: str) -> List[str]:
+        return [self.queue_key(site_id), self.offers_key(site_id), self.due_key(site_id), self.arrived_key(site_id)]
+
+    async def join(self, site_id: str, user_id: str) -> int:
+        """Queue the user, keeping the original place if already waiting; returns the 1-based position."""
+        async with self.redis_db.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.queue_key(site_id), {user_id: time.time()}, nx=True)
+            pipe.zrank(self.queue_key(site_id), user_id)
+            _, rank = await pipe.execute()
+        return rank + 1
+
+    async def leave(self, site_ids: List[str], user_id: str) -> List[str]:
+        """Remove the user from the queues of ``site_ids``; returns the sites where it was waiting."""
+        async with self.redis_db.pipeline(transaction=False) as pipe:
+            for site_id in site_ids:
+                pipe.zrem(self.queue_key(site_id), user_id)
+            removed = await pipe.execute()
+        return [site_id for site_id, flag in zip(site_ids, removed) if flag]
+
+    async def positions(self, site_ids: List[str], user_id: str) -> List[Optional[int]]:
+        """1-based position of the user in the queue of each site, None where not waiting."""
+        async with self.redis_db.pipeline(transaction=False) as pipe:
+            for site_id in site_ids:
+                pipe.zrank(self.queue_key(site_id), user_id)
+            ranks = await pipe.execute()
+        return [rank + 1 if rank is not None else None for rank in ranks]
+
+    async def wake(self, site_id: str, num: int) -> Optional[str]:
+        """Offer the freed machine ``num`` (1-based, as on the board) to the head waiter; returns who was woken."""
+        user = await self._wake(keys=self._keys(site_id), args=[num, time.time() + settings.WAIT_CLAIM_TIMEOUT])
+        return user.decode("utf-8") if user is not None else None
+
+    async def claim(self, site_id: str, num: int, user_id: str) -> bool:
+        """Accept an offer; False if it expired and went to somebody else."""
+        return bool(await self._claim(keys=self._keys(site_id)[1:], args=[num, user_id]))
+
+    async def resolve(self, site_id: str, num: int) -> Optional[str]:
+        """Forget the offer of a machine that became busy; returns the user put back in the queue, if any.
+
+        A claimed offer is already gone. An unclaimed one was taken from under its user, who keeps
+        their place instead of losing it to somebody outside the queue.
+        """
+        user = await self._resolve(keys=self._keys(site_id), args=[num])
+        return user.decode("utf-8") if user is not None else None
+
+    async def sweep(self, site_id: str) -> List[Tuple[int, str]]:
+        """Pass expired offers on and drop waiters older than ``WAIT_MAX_AGE``; returns the new offers."""
+        now = time.time()
+        offered = await self._sweep(
+            keys=self._keys(site_id) + [WashMachRedis.name_for(site_id)],
+            args=[now, now + settings.WAIT_CLAIM_TIMEOUT, now - settings.WAIT_MAX_AGE],
+        )
+        return [(int(offered[i]), offered[i + 1].decode("utf-8")) for i in range(0, len(offered), 2)]
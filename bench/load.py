@@ -0,0 +1,269 @@
+"""End-to-end load test of the bot: synthetic users drive ``main.dp`` through ``feed_update``.
+
+Telegram is replaced by a local mock Bot API server and Redis by an in-process fake, unless
+``--redis`` points to a server (use a scratch database: synthetic users subscribe there).
+Latency is measured from the moment an update was due, so an overloaded bot shows up as
+growing latency rather than as a lower send rate. The mock API shares the process and the loop,
+so the figures are a lower bound of what one bot process sustains. Throttling is off unless
+``THROTTLE_ENABLED=1`` is set; refused updates are then reported as ``throttled``, not ``completed``.
+
+    python bench/load.py --rate 200 --duration 30 --users 1000
+    python bench/load.py --mix status=70,callback=30 --api-latency 0.05 --out load.json
+"""
+import argparse, asyncio, contextvars, datetime, itertools, json, os, random, sys, time
+from collections import Counter as Tally, defaultdict
+from typing import Any, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_MIX = "status=40,callback=25,alert=10,setalert=10,start=10,clear=5"
+BOT_ID = 100000
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=100, help="updates per second (default 100)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to generate load for (default 10)")
+    parser.add_argument("--users", type=int, default=1000, help="number of synthetic users (default 1000)")
+    parser.add_argument("--machines", type=int, default=8, help="machines per site seeded into a fake Redis")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"update kinds and weights (default {DEFAULT_MIX})")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds the mock Bot API waits per call")
+    parser.add_argument("--redis", help="redis:// URL of a scratch database instead of the in-process fake")
+    parser.add_argument("--port", type=int, default=8788, help="port of the mock Bot API server")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the bot while under load")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="also write the JSON report to this file")
+    return parser.parse_args()
+
+
+ARGS = parse_args() if __name__ == "__main__" else None
+# The bot is configured from the environment at import time
+os.environ.setdefault("bot_token", f"{BOT_ID}:LOAD-TEST")
+os.environ.setdefault("LOG_LEVEL", ARGS.log_level if ARGS else "WARNING")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("NOTIFY_IN_BOT", "0")
+# Measure the handlers, not the token buckets: synthetic users press far faster than real ones
+os.environ.setdefault("THROTTLE_ENABLED", "0")
+
+import redis.asyncio as aioredis  # noqa: E402
+from aiohttp import web  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, MessageEntity, Update, User  # noqa: E402
+
+import settings, throttle, Usys  # noqa: E402
+
+# Set by ``bot_throttled_total`` while the update of the current task is handled
+_refused: contextvars.ContextVar = contextvars.ContextVar("refused")
+
+
+def count_refusals() -> None:
+    """Mark the update handled by the current task when the throttle refuses it."""
+    inc = throttle.THROTTLED.inc
+
+    def counting_inc(*labels: str, amount: float = 1) -> None:
+        inc(*labels, amount=amount)
+        flag = _refused.get(None)
+        if flag is not None:
+            flag.append(True)
+
+    throttle.THROTTLED.inc = counting_inc
+
+
+class MockBotAPI:
+    """Answers Bot API calls like Telegram would, counting them per method."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Tally = Tally()
+        self._message_ids = itertools.count(1)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "sendmessage":
+            result: Any = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bot"},
+                "text": data.get("text", ""),
+            }
+        elif method == "getme":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Bot", "username": "load_test_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+class UpdateFactory:
+    """Builds the updates a student would send: commands and presses of the ``№N`` buttons."""
+
+    def __init__(self, users: int, machines: List[Tuple[str, int]], rng: random.Random):
+        self.users = [User(id=10 ** 9 + i, is_bot=False, first_name=f"Student{i}") for i in range(users)]
+        self.machines = machines
+        self.rng = rng
+        self._ids = itertools.count(1)
+
+    def _message(self, user: User, text: str, update_id: int) -> Message:
+        command = text.split()[0]
+        return Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=user.id, type="private"),
+            from_user=user,
+            text=text,
+            entities=[MessageEntity(type="bot_command", offset=0, length=len(command))],
+        )
+
+    def build(self, kind: str) -> Update:
+        update_id = next(self._ids)
+        user = self.rng.choice(self.users)
+        if kind == "callback":
+            from main import PinAction
+            site_id, num = self.rng.choice(self.machines)
+            bot_message = Message(
+                message_id=update_id, date=datetime.datetime.now(), chat=Chat(id=user.id, type="private"),
+                from_user=User(id=BOT_ID, is_bot=True, first_name="Bot"), text="status",
+            )
+            return Update(update_id=update_id, callback_query=CallbackQuery(
+                id=str(update_id), from_user=user, chat_instance=str(user.id), message=bot_message,
+                data=PinAction(site=site_id, wash_id=num).pack(),
+            ))
+        if kind == "setalert":
+            site_id, num = self.rng.choice(self.machines)
+            text = f"/setalert {num + 1} {site_id}"
+        else:
+            text = f"/{kind}"
+        return Update(update_id=update_id, message=self._message(user, text, update_id))
+
+
+def percentile(values: List[float], p: float) -> float:
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+def redis_round_trips() -> int:
+    return sum(state[2] for state in Usys.REDIS_RTT._values.values())
+
+
+async def seed(redis_db: aioredis.Redis, machines: int) -> None:
+    """Put a board on every configured site, as a running scraper would."""
+    now = int(time.time())
+    for site in Usys.load_sites():
+        await redis_db.hset(Usys.WashMachRedis.name_for(site.site_id), mapping={
+            num: Usys.WashMachRedis.pack(num % 2 == 0, now) for num in range(1, machines + 1)
+        })
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    if args.redis:
+        Usys._redis_pool = aioredis.ConnectionPool.from_url(args.redis, max_connections=settings.REDIS_POOL_SIZE)
+    else:
+        import fakeredis
+        Usys._redis_pool = fakeredis.FakeAsyncRedis().connection_pool
+        await seed(Usys.redis_client(), args.machines)
+
+    api = MockBotAPI(args.api_latency)
+    api_runner = await api.start(args.port)
+
+    import main
+    main.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}"))
+    await main.dp.emit_startup(bot=main.bot, dispatcher=main.dp)
+    machines = [(meter.site.site_id, i) for meter, i in main.all_machines()]
+    if not machines:
+        sys.exit("No machines found in Redis: run the scraper first or use the in-process fake")
+
+    kinds, weights = zip(*[(kind, float(weight)) for kind, weight in
+                           (item.split("=") for item in args.mix.split(","))])
+    factory = UpdateFactory(args.users, machines, rng)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Tally = Tally()
+    throttled: Tally = Tally()
+    count_refusals()
+    tasks = []
+    round_trips_before = redis_round_trips()
+
+    async def send(kind: str, update: Update, due: float) -> None:
+        refused: List[bool] = []
+        _refused.set(refused)
+        try:
+            await main.dp.feed_update(main.bot, update)
+        except Exception as e:
+            errors[f"{kind}: {type(e).__name__}"] += 1
+            return
+        if refused:
+            throttled[kind] += 1
+            return
+        latencies[kind].append(time.perf_counter() - due)
+
+    total = int(args.rate * args.duration)
+    start = time.perf_counter()
+    for i in range(total):
+        due = start + i / args.rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = rng.choices(kinds, weights)[0]
+        tasks.append(asyncio.create_task(send(kind, factory.build(kind), due)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    round_trips = redis_round_trips() - round_trips_before
+
+    await main.dp.emit_shutdown(bot=main.bot, dispatcher=main.dp)
+    await main.bot.session.close()
+    await api_runner.cleanup()
+
+    completed = sum(len(values) for values in latencies.values())
+    everything = sorted(itertools.chain.from_iterable(latencies.values()))
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("out", "redis")},
+        "redis": "server" if args.redis else "fake",
+        "updates": total,
+        "completed": completed,
+        "throttled": dict(throttled),
+        "errors": dict(errors),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(completed / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(everything, 0.5) * 1000, 2),
+            "p99": round(percentile(everything, 0.99) * 1000, 2),
+            "max": round(everything[-1] * 1000, 2) if everything else 0.0,
+        },
+        "per_kind": {
+            kind: {
+                "count": len(values),
+                "p50_ms": round(percentile(sorted(values), 0.5) * 1000, 2),
+                "p99_ms": round(percentile(sorted(values), 0.99) * 1000, 2),
+            }
+            for kind, values in sorted(latencies.items())
+        },
+        "redis_round_trips_per_update": round(round_trips / total, 2) if total else 0.0,
+        "api_calls_per_update": round(sum(api.calls.values()) / total, 2) if total else 0.0,
+        "api_calls": dict(api.calls),
+    }
+
+
+def main() -> None:
+    report = asyncio.run(run(ARGS))
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if ARGS.out:
+        with open(ARGS.out, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
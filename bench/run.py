@@ -0,0 +1,280 @@
+"""Micro-benchmarks of the scraping, diffing and subscription hot paths.
+
+No network is used: pages come from ``bench/fixtures`` and Redis is an in-process fake unless
+``--redis`` points to a server (only ``*bench*`` keys are touched there and removed afterwards).
+
+    python bench/run.py --out before.json
+    python bench/run.py --compare before.json --out after.json   # exits with 1 on regressions
+"""
+import argparse, asyncio, json, os, platform, statistics, subprocess, sys, time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "bench", "fixtures")
+sys.path.insert(0, ROOT)
+# Malformed fixtures log warnings on purpose; keep them out of the timings and the console
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import events, extractor, Usys  # noqa: E402
+from snapshot import BoardSnapshot, MachineState, diff, parse_upd_ts  # noqa: E402
+
+SITE = "bench"
+MACHINES = 8
+SUBSCRIBERS = 100
+TS_A, TS_B = "26.01.2024 в 14:49", "26.01.2024 в 14:50"
+
+
+def load_fixtures() -> Dict[str, bytes]:
+    return {
+        os.path.splitext(name)[0]: open(os.path.join(FIXTURES, name), "rb").read()
+        for name in sorted(os.listdir(FIXTURES)) if name.endswith(".html")
+    }
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Per-operation timings in microseconds."""
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "median_us": round(statistics.median(samples) * 1e6, 3),
+        "min_us": round(samples[0] * 1e6, 3),
+        "p95_us": round(samples[min(len(samples) - 1, int(0.95 * len(samples)))] * 1e6, 3),
+        "mean_us": round(statistics.mean(samples) * 1e6, 3),
+    }
+
+
+def measure(func: Callable[[], Any], number: int, repeat: int) -> Dict[str, float]:
+    """Best-of style timing of a cheap synchronous call: ``repeat`` batches of ``number`` calls."""
+    func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return summarize(samples)
+
+
+async def ameasure(func: Callable[[], Awaitable[Any]], runs: int,
+                   setup: Optional[Callable[[], Awaitable[Any]]] = None) -> Dict[str, float]:
+    """Time each awaited call separately; ``setup`` runs before every call and is not timed."""
+    samples = []
+    for i in range(runs + 1):
+        if setup is not None:
+            await setup()
+        start = time.perf_counter()
+        await func()
+        if i:
+            samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+class _FakeResponse:
+    status = 200
+    charset = "utf-8"
+    headers: Dict[str, str] = {}
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+    async def read(self) -> bytes:
+        return self.content
+
+    async def __aenter__(self) -> "_FakeResponse":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        return None
+
+
+class _FakeSession:
+    """Stands in for the aiohttp session: serves the given pages in turn."""
+
+    closed = False
+
+    def __init__(self, pages: List[bytes]):
+        self.pages = pages
+        self.calls = 0
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> _FakeResponse:
+        self.calls += 1
+        return _FakeResponse(self.pages[self.calls % len(self.pages)])
+
+
+def bench_parsing(fixtures: Dict[str, bytes], scale: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name, content in fixtures.items():
+        for backend in extractor.available_backends():
+            results[f"parse:{name}:{backend}"] = measure(
+                lambda: extractor.extract_board(content, backend=backend), 10 * scale, 7)
+        results[f"digest:{name}"] = measure(lambda: extractor.fragment_digest(content), 200 * scale, 7)
+    return results
+
+
+def bench_diff(scale: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    upd_a, upd_b = parse_upd_ts(TS_A), parse_upd_ts(TS_B)
+    for count in (MACHINES, 200):
+        prev = BoardSnapshot(SITE, 1, {num: MachineState(num, False, upd_a) for num in range(1, count + 1)})
+        same = [(num, False) for num in range(1, count + 1)]
+        flipped = [(num, True) for num in range(1, count + 1)]
+        results[f"diff:unchanged:{count}"] = measure(lambda: diff(prev, same, upd_a, 0.0), 200 * scale, 7)
+        results[f"diff:all_changed:{count}"] = measure(lambda: diff(prev, flipped, upd_b, 0.0), 200 * scale, 7)
+    results["parse_upd_ts:cached"] = measure(lambda: parse_upd_ts(TS_A), 2000 * scale, 7)
+    return results
+
+
+async def bench_store(redis_db: Any, fixtures: Dict[str, bytes], scale: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    runs = 50 * scale
+    store = Usys.WashMachRedis(redis_db, SITE)
+    upd_a, upd_b = parse_upd_ts(TS_A), parse_upd_ts(TS_B)
+    prev = BoardSnapshot(SITE, 1, {num: MachineState(num, False, upd_a) for num in range(1, MACHINES + 1)})
+    snapshot, changed, transitions = diff(prev, [(num, True) for num in range(1, MACHINES + 1)], upd_b)
+    results["store:commit"] = await ameasure(lambda: store.commit(snapshot, changed, transitions), runs)
+    results["store:load_snapshot"] = await ameasure(store.load_snapshot, runs)
+    results["store:get_by_num"] = await ameasure(lambda: store.get_by_num(1), runs)
+
+    site = Usys.Site(SITE, "http://unimeter.invalid/bench")
+    for name, pages in (
+        ("unchanged", [fixtures["mixed"]]),
+        ("changed", [fixtures["free"].replace(TS_A.encode(), TS_B.encode()), fixtures["busy"]]),
+    ):
+        session = _FakeSession(pages)
+
+        async def session_factory() -> _FakeSession:
+            return session
+
+        meter = Usys.UniMeter(site, redis_db, server_mode=True, session_factory=session_factory)
+        results[f"cycle:{name}"] = await ameasure(meter.getData, runs)
+    return results
+
+
+async def bench_users(redis_db: Any, scale: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    runs = 50 * scale
+    users = Usys.RedisUser(redis_db)
+    machines = [(SITE, num) for num in range(MACHINES)]
+    user_ids = [f"bench-{i}" for i in range(SUBSCRIBERS)]
+
+    async def subscribe_all() -> None:
+        for user_id in user_ids:
+            await users.add_by_num(SITE, 0, user_id)
+
+    async def subscribe_everywhere() -> None:
+        for site_id, num in machines:
+            await users.add_by_num(site_id, num, user_ids[0])
+
+    results["users:add_by_num"] = await ameasure(lambda: users.add_by_num(SITE, 1, user_ids[0]), runs)
+    results["users:is_subscribed_many"] = await ameasure(lambda: users.is_subscribed_many(user_ids[0], machines), runs)
+    results["users:count_many"] = await ameasure(lambda: users.count_many(machines), runs)
+    results["users:get_by_user"] = await ameasure(lambda: users.get_by_user(user_ids[0]), runs)
+    results[f"users:pop_by_num:{SUBSCRIBERS}"] = await ameasure(
+        lambda: users.pop_by_num(SITE, 0), max(10, runs // 5), setup=subscribe_all)
+    results[f"users:clear_user:{MACHINES}"] = await ameasure(
+        lambda: users.clear_user(user_ids[0]), max(10, runs // 5), setup=subscribe_everywhere)
+    return results
+
+
+async def cleanup(redis_db: Any) -> None:
+    for pattern in (f"wash_board:{SITE}*", f"wash_alarmer:{SITE}:*", "wash_user:bench-*",
+                    f"wash_claim:*:{SITE}:*", f"wash_hist:{SITE}:*", f"wash_occ:{SITE}:*",
+                    f"wash_cycles:{SITE}", f"wash_eta:{SITE}", events.STREAM_KEY):
+        keys = [key async for key in redis_db.scan_iter(match=pattern)]
+        if keys:
+            await redis_db.delete(*keys)
+
+
+async def connect(url: Optional[str]) -> Any:
+    if url:
+        return Usys._TimedRedis.from_url(url)
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("fakeredis is not installed: pip install 'fakeredis[lua]' or pass --redis redis://...")
+    return Usys._TimedRedis(connection_pool=fakeredis.FakeAsyncRedis().connection_pool)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    fixtures = load_fixtures()
+    results = {}
+    results.update(bench_parsing(fixtures, args.scale))
+    results.update(bench_diff(args.scale))
+    redis_db = await connect(args.redis)
+    # Transitions committed by the benchmarks must never reach the real notifiers
+    events.STREAM_KEY = f"wash_events:{SITE}"
+    try:
+        await cleanup(redis_db)
+        results.update(await bench_store(redis_db, fixtures, args.scale))
+        results.update(await bench_users(redis_db, args.scale))
+    finally:
+        await cleanup(redis_db)
+        await redis_db.aclose() if hasattr(redis_db, "aclose") else await redis_db.close()
+    if args.filter:
+        results = {name: value for name, value in results.items() if args.filter in name}
+    return {"meta": meta(args), "results": results}
+
+
+def meta(args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "redis": "server" if args.redis else "fake",
+        "parser_backends": extractor.available_backends(),
+        "timestamp": int(time.time()),
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """Print median changes against ``baseline``; returns the benchmarks slower than ``threshold``."""
+    regressions = []
+    print(f"{'benchmark':40} {'before us':>12} {'after us':>12} {'change':>8}", file=sys.stderr)
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:40} {'-':>12} {result['median_us']:12.2f} {'new':>8}", file=sys.stderr)
+            continue
+        change = result["median_us"] / before["median_us"] - 1 if before["median_us"] else 0.0
+        flag = " !" if change > threshold else ""
+        print(f"{name:40} {before['median_us']:12.2f} {result['median_us']:12.2f} {change:+8.1%}{flag}",
+              file=sys.stderr)
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis", help="redis:// URL of a server to use instead of the in-process fake")
+    parser.add_argument("--out", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="relative slowdown of the median reported as a regression (default 0.25)")
+    parser.add_argument("--scale", type=int, default=1, help="multiply the number of iterations")
+    parser.add_argument("--filter", help="only keep benchmarks whose name contains this string")
+    args = parser.parse_args()
+
+    current = asyncio.run(run(args))
+    output = json.dumps(current, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), current, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
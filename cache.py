@@ -0,0 +1,78 @@
+import asyncio, time
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional
+
+import metrics, settings
+from logger import setup_logger
+
+# Create logger for cache
+logger = setup_logger('cache')
+
+RENDER_CACHE = metrics.Counter('bot_render_cache_total', 'Render cache lookups by result.', ('cache', 'result'))
+
+
+class Render(NamedTuple):
+    value: Any
+    # Board version of every site the value was rendered from
+    versions: Dict[str, int]
+    # Epoch after which the value is stale even without a new board, e.g. when a shown ETA passes
+    expires_at: Optional[float] = None
+
+
+class RenderCache:
+    """In-process cache of one rendered payload, kept until a newer board version is announced.
+
+    ``build`` returns a ``Render``. Concurrent misses wait for the same build, so a burst of
+    requests after a change costs one Redis read and one render. Entries older than
+    ``RENDER_CACHE_MAX_AGE`` are rebuilt in case an announcement was lost.
+    """
+
+    def __init__(self, name: str, build: Callable[[], Awaitable[Render]],
+                 max_age: float = settings.RENDER_CACHE_MAX_AGE):
+        self.name = name
+        self.build = build
+        self.max_age = max_age
+        self._render: Optional[Render] = None
+        self._built_at = 0.0
+        self._pending: Optional[asyncio.Future] = None
+
+    def invalidate(self, site_id: Optional[str] = None, version: Optional[int] = None) -> None:
+        """Drop the payload, unless it was already rendered from ``version`` of ``site_id`` or a newer one."""
+        render = self._render
+        if render is not None and site_id is not None and version is not None \
+                and render.versions.get(site_id, -1) >= version:
+            return
+        self._render = None
+        # Requests from now on must not join a build that may have read the old board
+        self._pending = None
+
+    def _fresh(self, render: Render, now: float) -> bool:
+        return now - self._built_at < self.max_age and (render.expires_at is None or now < render.expires_at)
+
+    async def get(self) -> Any:
+        render = self._render
+        if render is not None and self._fresh(render, time.time()):
+            RENDER_CACHE.inc(self.name, "hit")
+            return render.value
+        pending = self._pending
+        if pending is None:
+            RENDER_CACHE.inc(self.name, "miss")
+            pending = self._pending = asyncio.ensure_future(self._rebuild())
+        else:
+            RENDER_CACHE.inc(self.name, "coalesced")
+        # A cancelled request must not cancel the build the others are waiting for
+        return (await asyncio.shield(pending)).value
+
+    async def _rebuild(self) -> Render:
+        task = asyncio.current_task()
+        try:
+            render = await self.build()
+            if self._pending is task:
+                # Not invalidated while it ran
+                self._render, self._built_at = render, time.time()
+            return render
+        except Exception as e:
+            logger.error(f"Could not render {self.name}: {str(e)}")
+            raise
+        finally:
+            if self._pending is task:
+                self._pending = None
@@ -0,0 +1,119 @@
+import math, time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+import settings
+from logger import setup_logger
+from snapshot import BoardSnapshot, cabinet_dt
+
+# Create logger for eta
+logger = setup_logger('eta')
+
+SITE_WIDE = 'all'
+
+
+def stats_key(site_id: str) -> str:
+    """Cycle duration moments per ``<num|all>:<part of day>``: ``:n`` count and ``:s`` sum of seconds."""
+    return f'wash_eta:{site_id}'
+
+
+def part_of_day(ts: float) -> int:
+    return cabinet_dt(ts).hour // settings.ETA_BUCKET_HOURS
+
+
+def record(pipe: aioredis.client.Pipeline, site_id: str, num: int, started_at: int, duration: int) -> None:
+    """Queue the update of the duration statistics with one finished cycle."""
+    key = stats_key(site_id)
+    part = part_of_day(started_at)
+    for prefix in (f'{num}:{part}', f'{SITE_WIDE}:{part}', f'{num}:{SITE_WIDE}'):
+        pipe.hincrby(key, f'{prefix}:n', 1)
+        pipe.hincrby(key, f'{prefix}:s', duration)
+
+
+class CycleStats(NamedTuple):
+    count: int
+    total: int
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count
+
+
+class Estimator:
+    """Expected end of running cycles, from per machine and part-of-day duration statistics.
+
+    Statistics are reloaded from Redis at most every ``ETA_REFRESH`` seconds; predictions are cached
+    per snapshot version, so repeated ``/status`` calls on an unchanged board cost nothing.
+    """
+
+    def __init__(self, redis_db: aioredis.Redis):
+        self.redis_db = redis_db
+        self._stats: Dict[str, Dict[str, CycleStats]] = {}
+        self._loaded_at = -math.inf
+        self._predictions: Dict[str, Tuple[int, Dict[int, int]]] = {}
+
+    async def refresh(self, site_ids: List[str], force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._loaded_at < settings.ETA_REFRESH:
+            return
+        # Mark first so concurrent handlers do not all reload at once
+        self._loaded_at = now
+        try:
+            async with self.redis_db.pipeline(transaction=False) as pipe:
+                for site_id in site_ids:
+                    pipe.hgetall(stats_key(site_id))
+                results = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Could not load cycle statistics: {str(e)}")
+            return
+        self._stats = {site_id: self._parse(raw) for site_id, raw in zip(site_ids, results)}
+        self._predictions.clear()
+
+    @staticmethod
+    def _parse(raw: Dict[bytes, bytes]) -> Dict[str, CycleStats]:
+        moments: Dict[str, Dict[str, int]] = {}
+        for field, value in raw.items():
+            prefix, moment = field.decode("utf-8").rsplit(':', 1)
+            moments.setdefault(prefix, {})[moment] = int(value)
+        return {
+            prefix: CycleStats(values.get('n', 0), values.get('s', 0))
+            for prefix, values in moments.items() if values.get('n')
+        }
+
+    def expected(self, site_id: str, num: int, started_at: float) -> Optional[float]:
+        """Expected cycle duration in seconds, falling back from the machine to the whole site."""
+        stats = self._stats.get(site_id, {})
+        part = part_of_day(started_at)
+        for prefix in (f'{num}:{part}', f'{num}:{SITE_WIDE}', f'{SITE_WIDE}:{part}'):
+            item = stats.get(prefix)
+            if item is not None and item.count >= settings.ETA_MIN_SAMPLES:
+                return item.mean
+        return None
+
+    def eta(self, site_id: str, num: int, started_at: float) -> Optional[int]:
+        """Expected end epoch of a cycle started at ``started_at``."""
+        duration = self.expected(site_id, num, started_at)
+        return int(started_at + duration) if duration is not None else None
+
+    def predict(self, snapshot: BoardSnapshot) -> Dict[int, int]:
+        """Expected end epoch of every busy machine of the snapshot."""
+        cached = self._predictions.get(snapshot.site_id)
+        if cached is not None and cached[0] == snapshot.version:
+            return cached[1]
+        predictions = {}
+        for state in snapshot:
+            if state.status:
+                eta = self.eta(snapshot.site_id, state.num, state.upd_ts)
+                if eta is not None:
+                    predictions[state.num] = eta
+        self._predictions[snapshot.site_id] = (snapshot.version, predictions)
+        return predictions
+
+
+def describe(eta: int, now: Optional[float] = None) -> str:
+    """Human text of an expected end, "soon" once it has passed."""
+    now = time.time() if now is None else now
+    if eta <= now:
+        return "вот-вот освободится"
+    return f"освободится ~в {cabinet_dt(eta):%H:%M}"
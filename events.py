@@ -0,0 +1,197 @@
+import asyncio, json, os, socket, uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import redis
+import redis.asyncio as aioredis
+
+import settings
+from logger import setup_logger
+from snapshot import Transition
+
+# Create logger for events
+logger = setup_logger('events')
+
+STREAM_KEY = 'wash_events'
+GROUP = 'notifiers'
+# Pub/sub channel announcing ``<site>:<version>`` of every committed board
+BOARD_CHANNEL = 'wash_board:changed'
+
+
+def encode(transition: Transition) -> Dict[str, Any]:
+    """Stream entry fields for a status transition."""
+    return {
+        'site': transition.site_id,
+        'num': transition.num,
+        'status': int(transition.status),
+        'old_status': int(transition.old_status),
+        'upd_ts': transition.upd_ts,
+        'old_upd_ts': transition.old_upd_ts,
+    }
+
+
+def decode(fields: Dict[bytes, bytes]) -> Transition:
+    return Transition(
+        site_id=fields[b'site'].decode("utf-8"),
+        num=int(fields[b'num']),
+        status=fields[b'status'] == b'1',
+        old_status=fields[b'old_status'] == b'1',
+        upd_ts=int(fields[b'upd_ts']),
+        old_upd_ts=int(fields[b'old_upd_ts']),
+    )
+
+
+def decode_batch(fields: Dict[bytes, bytes]) -> List[Transition]:
+    """Transitions of a stream entry: a whole poll cycle, or a single one in entries older than batches."""
+    if b'batch' not in fields:
+        return [decode(fields)]
+    return [
+        decode({key.encode("utf-8"): str(value).encode("utf-8") for key, value in item.items()})
+        for item in json.loads(fields[b'batch'])
+    ]
+
+
+def publish(pipe: aioredis.client.Pipeline, transitions: List[Transition]) -> None:
+    """Queue one XADD for all ``transitions`` of a site's poll cycle, so they commit together with the board.
+
+    Consumers get the cycle as a whole and can send each subscriber a single message for it.
+    """
+    if transitions:
+        pipe.xadd(STREAM_KEY, {'batch': json.dumps([encode(transition) for transition in transitions])},
+                  maxlen=settings.EVENTS_MAXLEN, approximate=True)
+
+
+def announce(pipe: aioredis.client.Pipeline, site_id: str, version: int) -> None:
+    """Queue the announcement of a new board version, delivered once the transaction commits."""
+    pipe.publish(BOARD_CHANNEL, f'{site_id}:{version}')
+
+
+async def watch_boards(redis_db: aioredis.Redis, on_change: Callable[[Optional[str], Optional[int]], Any]) -> None:
+    """Call ``on_change(site_id, version)`` for every announced board until the task is cancelled.
+
+    Announcements are fire and forget, so ``on_change(None, None)`` is called after every
+    (re)subscription: anything may have changed while the connection was down.
+    """
+    while True:
+        pubsub = redis_db.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(BOARD_CHANNEL)
+            on_change(None, None)
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                site_id, version = message['data'].decode("utf-8").rsplit(':', 1)
+                on_change(site_id, int(version))
+        except asyncio.CancelledError:
+            raise
+        except redis.RedisError as e:
+            logger.error(f"Board announcements Redis error: {str(e)}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.reset()
+
+
+class EventConsumer:
+    """Consumer-group reader of status transitions, handled as ``handler(entry_id, transitions)``.
+
+    Every entry holds the transitions of one poll cycle of one site.
+
+    Entries are acknowledged only after the handler succeeds. Entries left pending by a crashed
+    consumer are claimed after ``EVENTS_CLAIM_IDLE_MS`` and handled again; an entry that keeps
+    failing is dropped after ``EVENTS_MAX_DELIVERIES`` attempts.
+    """
+
+    def __init__(self, redis_db: aioredis.Redis, handler: Callable[[str, List[Transition]], Awaitable[Any]],
+                 group: str = GROUP, consumer: Optional[str] = None):
+        self.redis_db = redis_db
+        self.handler = handler
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._attempts: Dict[bytes, int] = {}
+
+    async def ensure_group(self) -> None:
+        try:
+            await self.redis_db.xgroup_create(STREAM_KEY, self.group, id='0', mkstream=True)
+            logger.info(f"Created consumer group {self.group} on {STREAM_KEY}")
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _keep_claimed(self, entry_id: bytes) -> None:
+        """Reset the idle time of an entry while it is handled, so no other consumer reclaims it meanwhile."""
+        while True:
+            await asyncio.sleep(settings.EVENTS_CLAIM_IDLE_MS / 3000)
+            try:
+                await self.redis_db.xclaim(STREAM_KEY, self.group, self.consumer, 0, [entry_id], justid=True)
+            except redis.RedisError as e:
+                logger.error(f"Could not keep event {entry_id!r} claimed: {str(e)}")
+
+    async def _handle(self, entry_id: bytes, fields: Dict[bytes, bytes]) -> None:
+        # A long fan-out (many subscribers, a long retry_after) must not be handled twice
+        keeper = asyncio.create_task(self._keep_claimed(entry_id))
+        try:
+            await self.handler(entry_id.decode("utf-8"), decode_batch(fields))
+        except Exception as e:
+            attempts = self._attempts.get(entry_id, 0) + 1
+            if attempts < settings.EVENTS_MAX_DELIVERIES:
+                self._attempts[entry_id] = attempts
+                logger.error(f"Error handling event {entry_id!r} (attempt {attempts}): {str(e)}")
+                return
+            logger.error(f"Dropping event {entry_id!r} after {attempts} attempts: {str(e)}")
+        finally:
+            keeper.cancel()
+        self._attempts.pop(entry_id, None)
+        await self.redis_db.xack(STREAM_KEY, self.group, entry_id)
+
+    async def _handle_all(self, entries: List[Tuple[bytes, Dict[bytes, bytes]]]) -> None:
+        for entry_id, fields in entries:
+            if fields:
+                await self._handle(entry_id, fields)
+            else:
+                # Entry was trimmed from the stream while pending
+                await self.redis_db.xack(STREAM_KEY, self.group, entry_id)
+
+    async def reclaim(self) -> None:
+        """Handle entries left pending by this consumer or by consumers that stopped responding."""
+        start = '0-0'
+        while True:
+            result = await self.redis_db.xautoclaim(
+                STREAM_KEY, self.group, self.consumer,
+                min_idle_time=settings.EVENTS_CLAIM_IDLE_MS, start_id=start, count=100,
+            )
+            start, entries = result[0], result[1]
+            if entries:
+                logger.info(f"Reclaimed {len(entries)} pending events")
+                await self._handle_all(entries)
+            if start in (b'0-0', '0-0'):
+                break
+        await self._forget_idle_consumers()
+
+    async def _forget_idle_consumers(self) -> None:
+        """Remove consumers of stopped processes once nothing is pending for them."""
+        for info in await self.redis_db.xinfo_consumers(STREAM_KEY, self.group):
+            name = info['name'].decode("utf-8") if isinstance(info['name'], bytes) else info['name']
+            if name != self.consumer and info['pending'] == 0 and info['idle'] > settings.EVENTS_CONSUMER_TTL_MS:
+                await self.redis_db.xgroup_delconsumer(STREAM_KEY, self.group, name)
+
+    async def run(self) -> None:
+        """Consume events until the task is cancelled."""
+        logger.info(f"Starting event consumer {self.consumer}")
+        loop = asyncio.get_running_loop()
+        next_reclaim = 0.0
+        while True:
+            try:
+                if loop.time() >= next_reclaim:
+                    await self.ensure_group()
+                    await self.reclaim()
+                    next_reclaim = loop.time() + settings.EVENTS_CLAIM_IDLE_MS / 1000
+                response = await self.redis_db.xreadgroup(
+                    self.group, self.consumer, {STREAM_KEY: '>'},
+                    count=settings.EVENTS_BATCH, block=settings.EVENTS_BLOCK_MS,
+                )
+                for _, entries in response or []:
+                    await self._handle_all(entries)
+            except asyncio.CancelledError:
+                raise
+            except redis.RedisError as e:
+                logger.error(f"Event consumer Redis error: {str(e)}")
+                await asyncio.sleep(1)
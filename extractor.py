@@ -0,0 +1,236 @@
+import hashlib, re, time
+from typing import Any, Dict, List, Optional
+
+from bs4 import BeautifulSoup
+
+import metrics, settings
+from logger import setup_logger
+
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:  # lxml is optional, BeautifulSoup is used instead
+    etree = lxml_html = None
+
+# Create logger for extractor
+logger = setup_logger('extractor')
+
+PARSE_TIME = metrics.Histogram('unimeter_parse_seconds', 'Time to parse one cabinet page.', ('backend',))
+
+UPDATE_PREFIX = "Последний обмен данными"
+BLOCK_STYLE = "min-width: 179px;max-width:195px;"
+CIRCLE_STYLE = "width: 90px; height: 90px;"
+
+
+class MachineReading:
+    """State of one machine as read from the page."""
+
+    __slots__ = ("index", "num", "busy")
+
+    def __init__(self, index: int, num: int, busy: bool):
+        self.index = index
+        self.num = num
+        self.busy = busy
+
+    def __repr__(self) -> str:
+        return f"MachineReading(index={self.index}, num={self.num}, busy={self.busy})"
+
+
+class ParsedBoard:
+    """Everything extracted from one cabinet page."""
+
+    __slots__ = ("block_count", "machines", "upd_dt", "parse_time", "backend")
+
+    def __init__(self, block_count: int, machines: List[MachineReading], upd_dt: Optional[str],
+                 parse_time: float, backend: str):
+        self.block_count = block_count
+        self.machines = machines
+        self.upd_dt = upd_dt
+        self.parse_time = parse_time
+        self.backend = backend
+
+
+def _status(busy_text: Optional[str], number: int) -> bool:
+    """Resolve the busy flag the same way for every backend."""
+    if not busy_text:
+        logger.warning(f"Could not find status text for machine #{number} - defaulting to free")
+        return False
+    busy = "анято" in busy_text.lower()
+    logger.debug(f"Found status text for machine #{number}: '{busy_text}', busy: {busy}")
+    return busy
+
+
+def _border(has_danger: bool, has_success: bool, index: int) -> Optional[str]:
+    if has_danger:
+        return "danger"
+    if has_success:
+        return "success"
+    logger.warning(f"Unknown border class for machine block {index} - neither danger nor success found")
+    return None
+
+
+def _update_time(title: Optional[str]) -> Optional[str]:
+    if not title:
+        logger.warning("Could not find update time on the page")
+        return None
+    return title.replace(UPDATE_PREFIX + " ", "").strip()
+
+
+# --- lxml backend -----------------------------------------------------------
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+if etree is not None:
+    _XP_BLOCKS = etree.XPath(f"//div[{_has_class('col')}][@style='{BLOCK_STYLE}']")
+    _XP_UPDATE = etree.XPath(
+        f"(//div[@data-toggle='tooltip'][contains(@title, '{UPDATE_PREFIX}')])[1]/@title"
+    )
+    _XP_BORDER = {
+        name: etree.XPath(f"boolean(descendant-or-self::*[{_has_class('border-' + name)}])")
+        for name in ("danger", "success")
+    }
+    _XP_CIRCLE = etree.XPath(
+        f".//div[{_has_class('rounded-circle')}][{_has_class('border')}][{_has_class('mx-auto')}]"
+        f"[contains(@style, '{CIRCLE_STYLE}')]"
+    )
+    _XP_STATUS = {
+        name: etree.XPath(
+            f"(.//div[contains(@class, 'p-2 text-{name}')][.//div[{_has_class('text-center')}]])[last()]"
+            f"/descendant::div[{_has_class('text-center')}][1]"
+        )
+        for name in ("danger", "success")
+    }
+    _XP_STATUS_ANY = etree.XPath(
+        f"(.//div[{_has_class('p-2')}]//div[{_has_class('text-center')}])[1]"
+    )
+    _PARSERS: Dict[str, Any] = {}
+
+
+def _lxml_parser(encoding: str) -> Any:
+    parser = _PARSERS.get(encoding)
+    if parser is None:
+        parser = _PARSERS[encoding] = lxml_html.HTMLParser(encoding=encoding)
+    return parser
+
+
+def _extract_lxml(content: bytes, encoding: str) -> tuple:
+    root = lxml_html.document_fromstring(content, parser=_lxml_parser(encoding))
+    machines = []
+    blocks = _XP_BLOCKS(root)
+    for index, block in enumerate(blocks):
+        border = _border(_XP_BORDER["danger"](block), _XP_BORDER["success"](block), index)
+        circles = [
+            div for div in _XP_CIRCLE(block)
+            if border is None or f"border-{border}" in div.get("class", "").split()
+        ]
+        if not circles:
+            logger.warning(f"Could not find number div for machine block {index}")
+            continue
+        try:
+            number = int(circles[0].text_content().strip())
+        except ValueError:
+            logger.warning(f"Could not read machine number in block {index}")
+            continue
+        busy_text = None
+        for query in ((_XP_STATUS[border],) if border else ()) + (_XP_STATUS_ANY,):
+            found = query(block)
+            busy_text = found[0].text_content().strip() if found else None
+            if busy_text:
+                break
+        machines.append(MachineReading(index, number, _status(busy_text, number)))
+    titles = _XP_UPDATE(root)
+    return len(blocks), machines, _update_time(titles[0] if titles else None)
+
+
+# --- BeautifulSoup backend --------------------------------------------------
+
+def _classes(tag: Any) -> List[str]:
+    return tag.get("class") or []
+
+
+def _extract_bs4(content: bytes, encoding: str) -> tuple:
+    undata = BeautifulSoup(content, "html.parser", from_encoding=encoding)
+    machines = []
+    blocks = undata.find_all("div", {"class": "col", "style": BLOCK_STYLE})
+    for index, block in enumerate(blocks):
+        divs = block.find_all("div")
+        tags = [block] + divs
+        border = _border(
+            any("border-danger" in _classes(tag) for tag in tags),
+            any("border-success" in _classes(tag) for tag in tags),
+            index,
+        )
+        circle = next((
+            div for div in divs
+            if {"rounded-circle", "border", "mx-auto"}.issubset(_classes(div))
+            and CIRCLE_STYLE in div.get("style", "")
+            and (border is None or f"border-{border}" in _classes(div))
+        ), None)
+        if circle is None:
+            logger.warning(f"Could not find number div for machine block {index}")
+            continue
+        try:
+            number = int(circle.text.strip())
+        except ValueError:
+            logger.warning(f"Could not read machine number in block {index}")
+            continue
+        busy_text = None
+        if border:
+            status_divs = [
+                div for div in divs
+                if f"p-2 text-{border}" in " ".join(_classes(div)) and div.find("div", {"class": "text-center"})
+            ]
+            if status_divs:
+                busy_text = status_divs[-1].find("div", {"class": "text-center"}).text.strip()
+        if not busy_text:
+            for div in divs:
+                if "p-2" in _classes(div):
+                    text_center = div.find("div", {"class": "text-center"})
+                    if text_center:
+                        busy_text = text_center.text.strip()
+                        break
+        machines.append(MachineReading(index, number, _status(busy_text, number)))
+    update_div = undata.find("div", {"data-toggle": "tooltip", "title": lambda x: x and UPDATE_PREFIX in x})
+    return len(blocks), machines, _update_time(update_div["title"] if update_div else None)
+
+
+_SCRIPT_RE = re.compile(rb"<script\b.*?</script>", re.S | re.I)
+
+
+def fragment_digest(content: bytes) -> str:
+    """Hash of the part of the page the board is read from, without the head and inline scripts."""
+    starts = [i for i in (content.find(BLOCK_STYLE.encode()), content.find(UPDATE_PREFIX.encode())) if i >= 0]
+    start = min(starts) if starts else 0
+    end = content.rfind(b"</body>")
+    fragment = content[start:end if end > start else len(content)]
+    if b"<script" in fragment:
+        fragment = _SCRIPT_RE.sub(b"", fragment)
+    return hashlib.blake2b(fragment, digest_size=16).hexdigest()
+
+
+def available_backends() -> List[str]:
+    return (["lxml"] if etree is not None else []) + ["bs4"]
+
+
+def extract_board(content: bytes, encoding: str = "utf-8", backend: Optional[str] = None) -> ParsedBoard:
+    """Read every machine's number and busy flag plus the page-wide update time in one parse."""
+    backend = backend or settings.PARSER_BACKEND
+    if backend == "lxml" and etree is None:
+        backend = "bs4"
+    start = time.perf_counter()
+    try:
+        if backend == "lxml":
+            result = _extract_lxml(content, encoding)
+        else:
+            result = _extract_bs4(content, encoding)
+    except Exception as e:
+        if backend == "bs4":
+            raise
+        logger.warning(f"lxml failed to parse the page ({str(e)}), falling back to BeautifulSoup")
+        backend = "bs4"
+        result = _extract_bs4(content, encoding)
+    parse_time = time.perf_counter() - start
+    PARSE_TIME.observe(parse_time, backend)
+    logger.debug(f"Parsed {result[0]} machine blocks with {backend} in {parse_time * 1000:.2f} ms")
+    return ParsedBoard(*result, parse_time=parse_time, backend=backend)
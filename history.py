@@ -0,0 +1,172 @@
+import datetime, time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+import eta, settings
+from logger import setup_logger
+from snapshot import Transition, cabinet_dt
+
+# Create logger for history
+logger = setup_logger('history')
+
+HOUR = 3600
+DAY = 24 * HOUR
+# Upper edges of the cycle duration histogram, minutes
+CYCLE_BUCKETS = (15, 30, 45, 60, 75, 90, 120, 180, 360)
+
+
+def history_key(site_id: str, num: int) -> str:
+    """Sorted set of ``<epoch>:<status>`` members scored by epoch."""
+    return f'wash_hist:{site_id}:{num}'
+
+
+def hourly_key(site_id: str, hour: int) -> str:
+    """Busy seconds of every machine in the hour starting at epoch ``hour``."""
+    return f'wash_occ:{site_id}:h:{hour}'
+
+
+def daily_key(site_id: str, day: str) -> str:
+    """Busy seconds of every machine on ``day`` (YYYYMMDD, local time)."""
+    return f'wash_occ:{site_id}:d:{day}'
+
+
+def weekly_key(site_id: str) -> str:
+    """Busy seconds per ``<num>:<hour of week>`` over the whole lifetime, plus the ``since`` epoch."""
+    return f'wash_occ:{site_id}:week'
+
+
+def cycles_key(site_id: str) -> str:
+    """Cycle duration aggregates per machine: ``<num>:count``, ``<num>:sum``, ``<num>:le<minutes>``."""
+    return f'wash_cycles:{site_id}'
+
+
+def busy_intervals(start: int, end: int) -> List[Tuple[int, int]]:
+    """Split ``[start, end)`` at hour boundaries into ``(hour epoch, seconds)``."""
+    result = []
+    hour = start - start % HOUR
+    while hour < end:
+        seconds = min(end, hour + HOUR) - max(start, hour)
+        if seconds > 0:
+            result.append((hour, seconds))
+        hour += HOUR
+    return result
+
+
+def cycle_bucket(duration: int) -> str:
+    minutes = duration / 60
+    for edge in CYCLE_BUCKETS:
+        if minutes <= edge:
+            return f'le{edge}'
+    return 'inf'
+
+
+def record(pipe: aioredis.client.Pipeline, transitions: List[Transition]) -> None:
+    """Queue the history entries and aggregate updates of ``transitions`` on the board's pipeline.
+
+    Every transition is appended to the machine history. When a machine becomes free, its busy
+    interval is known and is added to the cycle statistics and to the hourly, daily and
+    hour-of-week occupancy buckets, so readers never have to go through the raw history.
+    """
+    now = int(time.time())
+    for transition in transitions:
+        site_id, num = transition.site_id, transition.num
+        key = history_key(site_id, num)
+        pipe.zadd(key, {f'{transition.upd_ts}:{int(transition.status)}': transition.upd_ts})
+        pipe.zremrangebyscore(key, '-inf', now - settings.HISTORY_RETENTION_DAYS * DAY)
+        pipe.zremrangebyrank(key, 0, -settings.HISTORY_MAX_ENTRIES - 1)
+
+        if not transition.old_status or transition.status:
+            continue
+        duration = transition.upd_ts - transition.old_upd_ts
+        if not 0 < duration <= settings.CYCLE_MAX_SECONDS:
+            # Missed polls or a stale board, not a real cycle
+            continue
+        cycles = cycles_key(site_id)
+        pipe.hincrby(cycles, f'{num}:count', 1)
+        pipe.hincrby(cycles, f'{num}:sum', duration)
+        pipe.hincrby(cycles, f'{num}:{cycle_bucket(duration)}', 1)
+        eta.record(pipe, site_id, num, transition.old_upd_ts, duration)
+
+        weekly = weekly_key(site_id)
+        pipe.hsetnx(weekly, 'since', transition.old_upd_ts)
+        for hour, seconds in busy_intervals(transition.old_upd_ts, transition.upd_ts):
+            local = cabinet_dt(hour)
+            hourly = hourly_key(site_id, hour)
+            daily = daily_key(site_id, local.strftime('%Y%m%d'))
+            pipe.hincrby(hourly, num, seconds)
+            pipe.expire(hourly, settings.OCCUPANCY_HOURLY_DAYS * DAY)
+            pipe.hincrby(daily, num, seconds)
+            pipe.expire(daily, settings.OCCUPANCY_DAILY_DAYS * DAY)
+            pipe.hincrby(weekly, f'{num}:{local.weekday() * 24 + local.hour}', seconds)
+
+
+class MachineStats(NamedTuple):
+    num: int
+    cycles: int
+    mean_cycle: Optional[float]
+    median_cycle: Optional[float]
+    busy_24h: float
+    busy_7d: float
+
+
+def _median_from_buckets(counts: Dict[str, int], total: int) -> Optional[float]:
+    """Upper edge of the histogram bucket holding the median, seconds."""
+    if not total:
+        return None
+    seen = 0
+    for edge in CYCLE_BUCKETS:
+        seen += counts.get(f'le{edge}', 0)
+        if seen * 2 >= total:
+            return edge * 60.0
+    return None
+
+
+async def site_stats(redis_db: aioredis.Redis, site_id: str, machines: List[int],
+                     now: Optional[float] = None) -> Tuple[List[MachineStats], List[Tuple[int, float]]]:
+    """Per-machine cycle and occupancy figures plus the busiest hours of the week, from aggregates only.
+
+    Reads one cycles hash, the last 24 hourly buckets, the last 7 daily buckets and the weekly hash in
+    a single round trip. Returns ``(machines, [(hour of week, average busy machines)])``.
+    """
+    now = time.time() if now is None else now
+    current_hour = int(now) - int(now) % HOUR
+    days = [cabinet_dt(now).date() - datetime.timedelta(days=i) for i in range(7)]
+    async with redis_db.pipeline(transaction=False) as pipe:
+        pipe.hgetall(cycles_key(site_id))
+        for i in range(24):
+            pipe.hgetall(hourly_key(site_id, current_hour - i * HOUR))
+        for day in days:
+            pipe.hgetall(daily_key(site_id, day.strftime('%Y%m%d')))
+        pipe.hgetall(weekly_key(site_id))
+        results = await pipe.execute()
+    cycles = {key.decode("utf-8"): int(value) for key, value in results[0].items()}
+    hourly, daily, weekly = results[1:25], results[25:32], results[32]
+
+    def busy_seconds(buckets: List[Dict[bytes, bytes]], num: int) -> int:
+        field = str(num).encode()
+        return sum(int(bucket.get(field, 0)) for bucket in buckets)
+
+    stats = []
+    for num in machines:
+        count = cycles.get(f'{num}:count', 0)
+        buckets = {key.split(':', 1)[1]: value for key, value in cycles.items() if key.startswith(f'{num}:le')}
+        stats.append(MachineStats(
+            num=num,
+            cycles=count,
+            mean_cycle=cycles.get(f'{num}:sum', 0) / count if count else None,
+            median_cycle=_median_from_buckets(buckets, count),
+            busy_24h=min(1.0, busy_seconds(hourly, num) / DAY),
+            busy_7d=min(1.0, busy_seconds(daily, num) / (7 * DAY)),
+        ))
+
+    since = int(weekly.get(b'since', now))
+    weeks = max(1.0, (now - since) / (7 * DAY))
+    by_hour: Dict[int, float] = {}
+    for key, value in weekly.items():
+        if key == b'since':
+            continue
+        how = int(key.split(b':', 1)[1])
+        by_hour[how] = by_hour.get(how, 0.0) + int(value) / HOUR / weeks
+    busiest = sorted(by_hour.items(), key=lambda item: item[1], reverse=True)
+    return stats, busiest
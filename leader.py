@@ -0,0 +1,188 @@
+import asyncio, os, socket, time
+from typing import Awaitable, Callable, Optional
+
+import redis
+import redis.asyncio as aioredis
+
+import metrics, settings
+from logger import setup_logger
+
+# Create logger for leader
+logger = setup_logger('leader')
+
+# How long work may take to stop through the stop hook before it is cancelled, seconds
+STOP_TIMEOUT = 30
+
+LEADER_KEY = 'wash_leader'
+TOKEN_KEY = 'wash_leader:token'
+
+IS_LEADER = metrics.Gauge('unimeter_leader', 'Whether this scraper replica holds the leader lease.')
+LEADER_CHANGES = metrics.Counter('unimeter_leader_changes_total', 'Leader lease terms won or lost here.', ('event',))
+
+
+class LeaseLost(Exception):
+    """Raised when a write is attempted without holding the current leader lease."""
+
+
+class LeaderLease:
+    """Scraper leadership as a Redis key holding ``<node>:<fencing token>`` with a TTL.
+
+    Every acquisition increments ``wash_leader:token``, so a replica that lost the lease and got it
+    back still has a different value than before. Writers check the value inside their transaction
+    (see ``WashMachRedis.commit``): a stale leader waking up after a pause cannot write.
+    """
+
+    # KEYS: lease, token counter; ARGV: node id, ttl ms. Returns the new token, or nil if taken.
+    ACQUIRE_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then return false end
+        local token = redis.call('INCR', KEYS[2])
+        redis.call('SET', KEYS[1], ARGV[1] .. ':' .. token, 'PX', ARGV[2])
+        return token
+    """
+
+    # KEYS: lease; ARGV: expected value, ttl ms
+    RENEW_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+
+    # KEYS: lease; ARGV: expected value
+    RELEASE_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, redis_db: aioredis.Redis, ttl: float = settings.LEADER_TTL, node_id: Optional[str] = None):
+        self.redis_db = redis_db
+        self.ttl = ttl
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.token: Optional[int] = None
+        self._acquire = redis_db.register_script(self.ACQUIRE_SCRIPT)
+        self._renew = redis_db.register_script(self.RENEW_SCRIPT)
+        self._release = redis_db.register_script(self.RELEASE_SCRIPT)
+
+    @property
+    def value(self) -> Optional[str]:
+        return f"{self.node_id}:{self.token}" if self.token is not None else None
+
+    def holds(self, value: Optional[bytes]) -> bool:
+        """Whether ``value``, read from ``LEADER_KEY``, is this replica's current lease."""
+        return self.token is not None and value is not None and value.decode("utf-8") == self.value
+
+    async def acquire(self) -> bool:
+        token = await self._acquire(keys=[LEADER_KEY, TOKEN_KEY], args=[self.node_id, int(self.ttl * 1000)])
+        if token is None:
+            return False
+        self.token = int(token)
+        return True
+
+    async def renew(self) -> bool:
+        if self.token is None:
+            return False
+        if await self._renew(keys=[LEADER_KEY], args=[self.value, int(self.ttl * 1000)]):
+            return True
+        self.token = None
+        return False
+
+    async def release(self) -> None:
+        if self.token is not None:
+            await self._release(keys=[LEADER_KEY], args=[self.value])
+            self.token = None
+
+
+class LeaderElector:
+    """Runs ``work`` only while this replica holds the lease; the other replicas wait hot.
+
+    The lease is renewed every third of its TTL, but only while ``healthy()`` says the poll loop
+    makes progress: a leader stuck in a poll lets the lease expire and is replaced. A standby
+    tries to take the lease at the same rate, so a crashed leader is replaced within
+    ``LEADER_TTL * 4/3`` seconds. When the lease is lost ``work`` is cancelled and the replica
+    becomes a standby again; when ``work`` returns the lease is released and ``run`` returns.
+
+    ``work`` is stopped through ``stop`` when given, and awaited before the lease is released or the
+    replica stands down; it is cancelled only if that fails. Cancelling ``dp.start_polling`` leaves
+    aiogram's inner polling tasks running, so a deposed leader would keep calling getUpdates.
+    """
+
+    def __init__(self, lease: LeaderLease, healthy: Callable[[], bool] = lambda: True,
+                 stop: Optional[Callable[[], Awaitable[None]]] = None):
+        self.lease = lease
+        self.healthy = healthy
+        self.stop = stop
+        self.interval = lease.ttl / 3
+
+    async def _try_acquire(self) -> bool:
+        try:
+            return await self.lease.acquire()
+        except redis.RedisError as e:
+            logger.error(f"Could not try the leader lease: {str(e)}")
+            return False
+
+    async def _hold(self, task: asyncio.Task) -> bool:
+        """Renew the lease until ``task`` finishes (False) or the lease is lost (True)."""
+        renewed_at = time.monotonic()
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=self.interval)
+            if done:
+                return False
+            if not self.healthy():
+                logger.warning("Poll loop is stuck, not renewing the leader lease")
+            else:
+                try:
+                    if not await self.lease.renew():
+                        logger.warning(f"Leader lease taken over, stepping down as {self.lease.node_id}")
+                        return True
+                    renewed_at = time.monotonic()
+                except redis.RedisError as e:
+                    logger.error(f"Could not renew the leader lease: {str(e)}")
+            if time.monotonic() - renewed_at >= self.lease.ttl:
+                logger.warning(f"Leader lease expired, stepping down as {self.lease.node_id}")
+                self.lease.token = None
+                return True
+
+    async def _stop(self, task: asyncio.Task) -> None:
+        if self.stop is not None:
+            try:
+                await asyncio.wait_for(self.stop(), STOP_TIMEOUT)
+            except Exception as e:
+                logger.error(f"Could not stop the leader's work gracefully, cancelling it: {e!r}")
+        if not task.done():
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def _release(self) -> None:
+        try:
+            await self.lease.release()
+        except redis.RedisError as e:
+            logger.error(f"Could not release the leader lease: {str(e)}")
+            return
+        logger.info(f"Replica {self.lease.node_id} released the leader lease")
+
+    async def run(self, work: Callable[[], Awaitable[None]]) -> None:
+        logger.info(f"Replica {self.lease.node_id} waiting for the leader lease")
+        while True:
+            while not await self._try_acquire():
+                await asyncio.sleep(self.interval)
+            logger.info(f"Replica {self.lease.node_id} is the leader, fencing token {self.lease.token}")
+            IS_LEADER.set(1)
+            LEADER_CHANGES.inc("acquired")
+            task = asyncio.create_task(work())
+            lost = False
+            try:
+                lost = await self._hold(task)
+            finally:
+                # Also reached when ``run`` itself is cancelled: hand the lease over right away
+                IS_LEADER.set(0)
+                if not task.done():
+                    await self._stop(task)
+                if not lost:
+                    await self._release()
+            if not lost:
+                return task.result()
+            LEADER_CHANGES.inc("lost")
+            # Give the standbys a full lease period to take over before competing again
+            await asyncio.sleep(self.lease.ttl)
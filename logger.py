@@ -1,68 +1,236 @@
 import logging
+import logging.handlers
+import atexit
 import functools
+import inspect
+import os
+import queue
+import random
+import reprlib
 import time
-from typing import Callable, Any
+from typing import Callable, Any, Dict, Optional, Set
 import json
 
-# Настраиваем базовый logger
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+import settings
+
+# Максимальная длина аргументов и результата в логе вызова
+REPR_LIMIT = 200
+DEBUG = logging.DEBUG
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна компактная JSON-строка на запись"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': self.formatTime(record, DATE_FORMAT) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+class RotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """Ротация по времени (``when``) и по размеру файла (``max_bytes``)"""
+
+    def __init__(self, filename: str, max_bytes: int, **kwargs):
+        super().__init__(filename, delay=True, encoding='utf-8', **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> int:
+        if super().shouldRollover(record):
+            return 1
+        if self.max_bytes > 0 and self.stream is not None and self.stream.tell() >= self.max_bytes:
+            return 1
+        return 0
+
+    def rotation_filename(self, default_name: str) -> str:
+        # Несколько ротаций по размеру за один период не должны затирать друг друга
+        name, n = default_name, 0
+        while os.path.exists(name):
+            n += 1
+            name = f'{default_name}.{n}'
+        return name
+
+
+class _FileRouter(logging.Handler):
+    """Пишет запись в файл своего logger; работает только в потоке записи"""
+
+    def __init__(self):
+        super().__init__()
+        self._files: Dict[str, logging.Handler] = {}
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.name not in _file_loggers:
+            return
+        handler = self._files.get(record.name)
+        if handler is None:
+            os.makedirs(settings.LOG_DIR, exist_ok=True)
+            handler = self._files[record.name] = RotatingFileHandler(
+                os.path.join(settings.LOG_DIR, f'{record.name}.log'), settings.LOG_MAX_BYTES,
+                when=settings.LOG_ROTATE_WHEN, backupCount=settings.LOG_BACKUPS,
+            )
+            handler.setFormatter(JsonFormatter())
+        handler.handle(record)
+
+    def close(self) -> None:
+        for handler in self._files.values():
+            handler.close()
+        super().close()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь и никогда не ждет: при переполнении запись отбрасывается"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Очередь внутри процесса: форматирование (и exc_info для JsonFormatter) остается потоку записи
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_file_loggers: Set[str] = set()
+
+
+def _level(name: str, default: Optional[str] = None) -> Optional[int]:
+    value = settings.LOG_LEVELS.get(name, default)
+    return logging.getLevelName(value.upper()) if value else None
+
+
+def _configure() -> None:
+    """Один раз на процесс: root пишет в очередь, а файлы и консоль обслуживает один фоновый поток"""
+    global _listener
+    if _listener is not None:
+        return
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT, DATE_FORMAT))
+    _listener = logging.handlers.QueueListener(
+        queue.Queue(settings.LOG_QUEUE_SIZE), console, _FileRouter(), respect_handler_level=True,
+    )
+    root = logging.getLogger()
+    root.setLevel(_level('root', settings.LOG_LEVEL))
+    root.addHandler(_QueueHandler(_listener.queue))
+    for name in settings.LOG_LEVELS:
+        if name != 'root':
+            logging.getLogger(name).setLevel(_level(name))
+    _listener.start()
+    atexit.register(_listener.stop)
+
 
 def setup_logger(name: str) -> logging.Logger:
-    """Создает и возвращает настроенный logger"""
-    logger = logging.getLogger(name)
-    
-    # Добавляем обработчик для записи в файл
-    file_handler = logging.FileHandler(f'logs/{name}.log')
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    ))
-    logger.addHandler(file_handler)
-    
-    return logger
-
-def log_function(logger: logging.Logger):
-    """Декоратор для логирования функций"""
+    """Создает и возвращает настроенный logger; повторный вызов ничего не добавляет"""
+    _configure()
+    _file_loggers.add(name)
+    return logging.getLogger(name)
+
+
+def dropped_records() -> int:
+    """Сколько записей отброшено из-за переполненной очереди"""
+    root = logging.getLogger()
+    return sum(handler.dropped for handler in root.handlers if isinstance(handler, _QueueHandler))
+
+class _Call:
+    """Сообщение о вызове функции; аргументы и результат сериализуются, только если запись форматируется"""
+
+    __slots__ = ("data", "args", "kwargs", "result", "limit")
+
+    def __init__(self, data: dict, args: Any, kwargs: Any, result: Any, limit: int):
+        self.data = data
+        self.args = args
+        self.kwargs = kwargs
+        self.result = result
+        self.limit = limit
+
+    def __str__(self) -> str:
+        data = dict(self.data, args=_short(self.args, self.limit), kwargs=_short(self.kwargs, self.limit))
+        if self.data['status'] == 'success':
+            data['result'] = _short(self.result, self.limit)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _short(value: Any, limit: int) -> str:
+    """repr, обрезанный до ``limit`` символов; большие коллекции не обходятся целиком"""
+    text = _repr.repr(value)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+_repr = reprlib.Repr()
+_repr.maxstring = _repr.maxother = REPR_LIMIT
+_repr.maxlevel = 2
+
+
+def log_function(logger: logging.Logger, sample: float = 1.0, limit: int = REPR_LIMIT):
+    """Декоратор для логирования функций
+
+    Вызовы пишутся на уровне DEBUG: если он выключен, обертка только вызывает функцию и при ошибке
+    пишет ERROR. ``sample`` - доля вызовов, которые попадают в лог, ``limit`` - максимальная длина
+    аргументов и результата. Корутины оборачиваются корутиной, поэтому время выполнения честное.
+    """
     def decorator(func: Callable) -> Callable:
+        name = func.__qualname__
+
+        def success(start: float, args: tuple, kwargs: dict, result: Any) -> None:
+            logger.debug('%s', _Call(
+                {'function': name, 'status': 'success', 'execution_time': f'{time.perf_counter() - start:.4f}s'},
+                args, kwargs, result, limit,
+            ))
+
+        def error(start: Optional[float], args: tuple, kwargs: dict, e: Exception) -> None:
+            if not logger.isEnabledFor(logging.ERROR):
+                return
+            data = {'function': name, 'status': 'error', 'error': str(e)}
+            if start is not None:
+                data['execution_time'] = f'{time.perf_counter() - start:.4f}s'
+            logger.error('%s', _Call(data, args, kwargs, None, limit))
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs) -> Any:
+                if not (logger.isEnabledFor(DEBUG) and (sample >= 1 or random.random() < sample)):
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as e:
+                        error(None, args, kwargs, e)
+                        raise
+                start = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    error(start, args, kwargs, e)
+                    raise
+                success(start, args, kwargs, result)
+                return result
+
+            return async_wrapper
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs) -> Any:
-            start_time = time.time()
-            
-            # Подготовка информации для логирования
-            log_data = {
-                'function': func.__name__,
-                'args': str(args),
-                'kwargs': str(kwargs),
-                'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
-            }
-            
+            if not (logger.isEnabledFor(DEBUG) and (sample >= 1 or random.random() < sample)):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    error(None, args, kwargs, e)
+                    raise
+            start = time.perf_counter()
             try:
                 result = func(*args, **kwargs)
-                execution_time = time.time() - start_time
-                
-                log_data.update({
-                    'status': 'success',
-                    'execution_time': f'{execution_time:.4f}s',
-                    'result': str(result)
-                })
-                
-                logger.debug(json.dumps(log_data))
-                return result
-                
             except Exception as e:
-                execution_time = time.time() - start_time
-                
-                log_data.update({
-                    'status': 'error',
-                    'error': str(e),
-                    'execution_time': f'{execution_time:.4f}s'
-                })
-                
-                logger.error(json.dumps(log_data))
+                error(start, args, kwargs, e)
                 raise
-                
+            success(start, args, kwargs, result)
+            return result
+
         return wrapper
-    return decorator 
\ No newline at end of file
+    return decorator
@@ -1,130 +1,254 @@
-import asyncio, logging, Usys, redis, settings
+import asyncio, cache, eta, events, history, metrics, throttle, time, Usys, settings, webhook
 import json
 from enum import Enum
+from typing import List, Optional, Tuple
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.dispatcher import router
 from aiogram.enums import parse_mode
 from aiogram.filters import Command, CommandObject
 from aiogram.filters.callback_data import CallbackData
+from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.formatting import (
     Bold, Italic, as_list, as_marked_section, as_key_value, HashTag
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.utils.text_decorations import markdown_decoration
 from logger import setup_logger, log_function
+from notifier import DeliveryQueue, Notifier, TakeAction, create_consumer
 
 # Create logger for main
 logger = setup_logger('main')
 
-# Включаем логирование, чтобы не пропустить важные сообщения
-logging.basicConfig(level=logging.INFO)
 # Объект бота
 bot = Bot(token=settings.BOT_TOKEN)
-main_sys = Usys.UniMeter(redis.StrictRedis(
-    **settings.REDIS_DB
-))
-# Диспетчер
-dp = Dispatcher()
-redis_db = Usys.RedisUser(redis.StrictRedis(
-    **settings.REDIS_DB
-))
+# Один пул соединений с Redis на весь процесс
+redis_client = Usys.redis_client()
+main_sys = Usys.SiteRegistry(redis_client)
+# Диспетчер; состояние хранится в Redis, чтобы его видели все воркеры
+dp = Dispatcher(storage=RedisStorage(redis_client))
+redis_db = Usys.RedisUser(redis_client)
+estimator = eta.Estimator(redis_client)
+# Очередь «любая свободная машинка»
+waits = Usys.WaitQueue(redis_client)
+
+delivery = DeliveryQueue(bot, redis_client)
+notifier = Notifier(delivery, redis_db, estimator=estimator)
+background_tasks: List[asyncio.Task] = []
+metrics_runner = None
+dp.message.middleware(metrics.handler_middleware)
+dp.callback_query.middleware(metrics.handler_middleware)
+if settings.BOT_MODE == "webhook":
+    # Несколько воркеров: каждый update обрабатывается один раз
+    dp.update.outer_middleware(webhook.dedup_middleware(redis_client))
+if settings.THROTTLE_ENABLED:
+    # Лимиты общие для всех воркеров, поэтому в Redis
+    throttle_middleware = throttle.middleware(redis_client)
+    dp.message.outer_middleware(throttle_middleware)
+    dp.callback_query.outer_middleware(throttle_middleware)
+
+@dp.startup()
+@log_function(logger)
+async def on_startup(*args, **kwargs):
+    global metrics_runner
+    metrics_runner = await metrics.start_server()
+    await main_sys.prepare()
+    await redis_db.build_reverse_index()
+    background_tasks.append(asyncio.create_task(events.watch_boards(redis_client, status_cache.invalidate)))
+    if settings.NOTIFY_IN_BOT:
+        logger.info("Starting transition event consumer")
+        background_tasks.append(asyncio.create_task(create_consumer(delivery, redis_db, notifier).run()))
+        background_tasks.append(asyncio.create_task(notifier.run_sweeper()))
+
+@dp.shutdown()
+@log_function(logger)
+async def on_shutdown(*args, **kwargs):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await delivery.close()
+    await Usys.close_redis()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+class PinAction(CallbackData, prefix="pin"):
+    site: str
+    wash_id: int
 
 class AdminAction(CallbackData, prefix="adm"):
     user_id: int
+    site: str
     wash_id: int
 
-@log_function(logger)
-def pin(machine, user_id):
-    logger.info(f"User {user_id} subscribing to machine #{machine}")
-    redis_db.add_by_num(machine, str(user_id))
-    item = main_sys.arr_washes[int(machine)]
-    item.get_info()
-    return "Вы подписались!\n" + item.to_string()
+def machine_title(meter: Usys.UniMeter, i: int) -> str:
+    """Machine name for buttons and lists, prefixed with the site title when several sites are served."""
+    return f"{meter.site.title} №{i+1}" if len(main_sys) > 1 else f"№{i+1}"
+
+def queue_title(meter: Usys.UniMeter) -> str:
+    """Name of the "any free machine" queue of a site."""
+    return f"{meter.site.title}: любая машинка" if len(main_sys) > 1 else "Любая машинка"
+
+def all_machines():
+    """List of (meter, machine index) of every known machine, in display order."""
+    return [(meter, i) for meter in main_sys for i in range(len(meter.arr_washes))]
+
+async def subscribed_machines(user_id: str):
+    """List of (meter, machine index) the user is subscribed to, checked in one round trip."""
+    machines = all_machines()
+    flags = await redis_db.is_subscribed_many(user_id, [(meter.site.site_id, i) for meter, i in machines])
+    return [machine for machine, subscribed in zip(machines, flags) if subscribed]
 
-@dp.message(Command("status"))
 @log_function(logger)
-async def get_statuses(message: Message):
-    logger.info(f"Status requested by user {message.from_user.id}")
-    data_unparse = main_sys.getData()
+async def pin(site_id, machine, user_id):
+    logger.info(f"User {user_id} subscribing to machine #{machine} on site {site_id}")
+    await redis_db.add_by_num(site_id, machine, str(user_id))
+    item = main_sys.get(site_id).arr_washes[int(machine)]
+    await item.get_info()
+    await estimator.refresh(list(main_sys.meters))
+    return "Вы подписались!\n" + item.to_string(
+        eta_ts=estimator.eta(site_id, item.num, item.upd_dt.timestamp()) if item.status else None
+    )
+
+def stale_note(fetched_at: float, now: float) -> Tuple[Optional[str], float]:
+    """Пометка об устаревших данных и момент, когда её надо перерисовать"""
+    age = now - fetched_at
+    if age < settings.STALE_AFTER:
+        return None, fetched_at + settings.STALE_AFTER
+    minutes = int(age // 60)
+    return f"⚠️ Данные устарели: обновлены {minutes} мин назад", fetched_at + (minutes + 1) * 60
+
+# Telegram не принимает ряды шире 8 кнопок
+MAX_ROW_WIDTH = 8
+
+def row_widths(count: int) -> List[int]:
+    """Ширины рядов для count кнопок одного сайта: не больше MAX_ROW_WIDTH, ряды поровну"""
+    rows = -(-count // MAX_ROW_WIDTH)
+    return [count // rows + (1 if i < count % rows else 0) for i in range(rows)]
+
+async def render_status() -> cache.Render:
+    """Текст и клавиатура /status по текущим доскам всех сайтов"""
+    data_unparse = await main_sys.getData()
+    await estimator.refresh(list(data_unparse))
+    predictions = {site_id: estimator.predict(main_sys.get(site_id).snapshot) for site_id in data_unparse}
+    now = time.time()
+    # Пока сайт недоступен, показываем последнюю доску с пометкой о её возрасте
+    notes, expiry = {}, []
+    for site_id in data_unparse:
+        fetched_at = main_sys.get(site_id).snapshot.fetched_at
+        if fetched_at is not None:
+            notes[site_id], refresh_at = stale_note(fetched_at, now)
+            expiry.append(refresh_at)
     content = as_list(
-        as_marked_section(
-            Bold("ВСЕ стиралки:"),
-            *[item.to_string(date=False) for item in data_unparse],
-            marker="  ",
-        ),
+        *[
+            as_marked_section(
+                Bold(f"{main_sys.get(site_id).site.title}:" if len(main_sys) > 1 else "ВСЕ стиралки:"),
+                *([Italic(notes[site_id])] if notes.get(site_id) else []),
+                *[
+                    item.to_string(date=False, eta_ts=predictions[site_id].get(item.num))
+                    for item in washes
+                ],
+                marker="  ",
+            )
+            for site_id, washes in data_unparse.items()
+        ],
         Italic("Можете подписаться на изменение к стиралке:"),
         sep="\n\n",
     )
     builder = InlineKeyboardBuilder()
-    for i in range(6):
-        builder.button(
-            text=f"№{i+1}",
-            callback_data="{wash_id}_{user_id}".format(wash_id=i, user_id=message.from_user.id)
-        )
-    await message.answer(**content.as_kwargs(), reply_markup=builder.as_markup())
+    for site_id, washes in data_unparse.items():
+        meter = main_sys.get(site_id)
+        for i in range(len(washes)):
+            builder.button(
+                text=machine_title(meter, i),
+                callback_data=PinAction(site=site_id, wash_id=i)
+            )
+    builder.adjust(*[width for washes in data_unparse.values() for width in row_widths(len(washes))])
+    # ETA в виде времени превращается в «вот-вот» после наступления, возраст данных растёт
+    expiry += [ts for etas in predictions.values() for ts in etas.values() if ts > now]
+    return cache.Render(
+        value=(content.as_kwargs(), builder.as_markup()),
+        versions={site_id: main_sys.get(site_id).snapshot.version for site_id in data_unparse},
+        expires_at=min(expiry, default=None),
+    )
+
+# Один рендер /status на версию досок, одновременные промахи ждут одну сборку
+status_cache = cache.RenderCache("status", render_status)
+
+@dp.message(Command("status"))
+@log_function(logger)
+async def get_statuses(message: Message):
+    logger.info(f"Status requested by user {message.from_user.id}")
+    content, keyboard = await status_cache.get()
+    await message.answer(**content, reply_markup=keyboard)
 
 @dp.message(Command("alert"))
 @log_function(logger)
 async def cmd_alert(message: types.Message):
     logger.info(f"Alert subscriptions requested by user {message.from_user.id}")
-    data = []
-    for i in range(6):
-        data.append(str(message.from_user.id) in redis_db.get_by_num(i))
+    data = await subscribed_machines(str(message.from_user.id))
+    positions = await waits.positions(list(main_sys.meters), str(message.from_user.id))
+    lines = [f'{markdown_decoration.quote(machine_title(meter, i))} стирка' for meter, i in data] + [
+        markdown_decoration.quote(f"{queue_title(meter)}, вы #{position} в очереди")
+        for meter, position in zip(main_sys, positions) if position
+    ]
 
     await message.answer("*Вы подписались на 🔔оповещение🔔:*  \n 🔹 " +\
-                         ("\n 🔹 ".join([f'№{i+1} стирка' for i, item in enumerate(data) if item]) if sum(data) else "Пусто"),
+                         ("\n 🔹 ".join(lines) if lines else "Пусто"),
                          parse_mode=parse_mode.ParseMode.MARKDOWN_V2)
 
 @dp.message(Command("clear"))
 @log_function(logger)
 async def cmd_clear(message: types.Message):
     logger.info(f"Clear subscriptions requested by user {message.from_user.id}")
-    data = []
-    for i in range(6):
-        data.append(str(message.from_user.id) in redis_db.get_by_num(i))
-        if str(message.from_user.id) in redis_db.get_by_num(i):
-            redis_db.remove_by_num(i,str(message.from_user.id))
+    removed = set(await redis_db.clear_user(str(message.from_user.id)))
+    data = [(meter, i) for meter, i in all_machines() if (meter.site.site_id, i) in removed]
+    left = await waits.leave(list(main_sys.meters), str(message.from_user.id))
+    lines = [f'{markdown_decoration.quote(machine_title(meter, i))} стирка' for meter, i in data] + [
+        markdown_decoration.quote(queue_title(main_sys.get(site_id))) for site_id in left
+    ]
 
     await message.answer("*Вы ОТПИСАЛИСЬ от 🔕оповещений🔕:*  \n 🔹 " +\
-                         ("\n 🔹 ".join([f'№{i+1} стирка' for i, item in enumerate(data) if item]) if sum(data) else "Пусто"),
+                         ("\n 🔹 ".join(lines) if lines else "Пусто"),
                          parse_mode=parse_mode.ParseMode.MARKDOWN_V2)
 
+START_COMMANDS = {
+    "start": ("Информация по боту\. Список команд\.", "🔰Информация"),
+    "status":("Список статусов стиралок", "🌐Статусы стиралок"),
+    "setalert \<number\>":(
+        "Подписка единоразовая на получение изменения статуса\. То есть если стиралка достирала, "
+        "то вы получите сообщение об этом и подписка исчезнет\!",
+        ""),
+    "any":("Встать в очередь на любую машинку: освободится \- сообщу первому в очереди", "⏳Любая машинка"),
+    "alert":("Список на какие машинки вы подписаны", "🔔Подписанные машинки"),
+    "clear":("Удаление всех подписок", "❌Удалить подписки"),
+}
+# Приветствие и клавиатура не меняются, собираем их один раз
+START_KEYBOARD = types.ReplyKeyboardMarkup(keyboard=[
+    [types.KeyboardButton(text=f"/{i} - {START_COMMANDS[i][1]}")] for i in START_COMMANDS if "setalert" not in i
+])
+START_TEXT = ("Приветики\! \n _Бот напомнит вам, что ваша машинка достиралась\! или что она наконец освободилось"
+              " и можно идти забирать вещи\._\n Написал [@arefaste]()"
+              "\n*Команды:*"
+              "\n 🔹 "+"\n 🔹 ".join([f'/{item} \- {START_COMMANDS[item][0]}' for item in START_COMMANDS])+\
+              "\n\n")
+
 @dp.message(Command("start"))
 @log_function(logger)
 async def cmd_start(message: types.Message):
     logger.info(f"Start command received from user {message.from_user.id}")
     try:
-        redis_db.add_user_data(str(message.from_user.id) + "_" + message.from_user.full_name)
+        await redis_db.add_user_data(str(message.from_user.id) + "_" + message.from_user.full_name)
     finally:
         pass
-    data = {
-        "start": ("Информация по боту\. Список команд\.", "🔰Информация"),
-        "status":("Список статусов стиралок", "🌐Статусы стиралок"),
-        "setalert \<number\>":(
-            "Подписка единоразовая на получение изменения статуса\. То есть если стиралка достирала, "
-            "то вы получите сообщение об этом и подписка исчезнет\!",
-            ""),
-        "alert":("Список на какие машинки вы подписаны", "🔔Подписанные машинки"),
-        "clear":("Удаление всех подписок", "❌Удалить подписки"),
-    }
-
-    kb = [
-        [types.KeyboardButton(text=f"/{i} - {data[i][1]}")] for i in data if "setalert" not in i
-    ]
-    keyboard = types.ReplyKeyboardMarkup(keyboard=kb)
-    await message.answer("Приветики\! \n _Бот напомнит вам, что ваша машинка достиралась\! или что она наконец освободилось"
-                         " и можно идти забирать вещи\._\n Написал [@arefaste]()"
-                         "\n*Команды:*"
-                         "\n 🔹 "+"\n 🔹 ".join([f'/{item} \- {data[item][0]}' for item in data])+\
-                         "\n\n", parse_mode=parse_mode.ParseMode.MARKDOWN_V2,
-                         reply_markup=keyboard)
+    await message.answer(START_TEXT, parse_mode=parse_mode.ParseMode.MARKDOWN_V2, reply_markup=START_KEYBOARD)
 
-@dp.callback_query()
+@dp.callback_query(PinAction.filter())
 @log_function(logger)
-async def send_random_value(callback: types.CallbackQuery):
+async def send_random_value(callback: types.CallbackQuery, callback_data: PinAction):
     logger.info(f"Callback query received from user {callback.from_user.id}")
-    text = pin(*list(map(int, callback.data.split("_"))))
+    text = await pin(callback_data.site, callback_data.wash_id, callback.from_user.id)
     await callback.message.answer(text)
     await callback.answer(
         text=text,
@@ -145,22 +269,58 @@ async def cmd_setalert(
         )
         return
     try:
-        machine = int(command.args.split(" ", maxsplit=1)[0])
-        if not 0 < machine < 7:
+        args = command.args.split()
+        machine = int(args[0])
+        meter = main_sys.get(args[1]) if len(args) > 1 else main_sys.default
+        if meter is None or not 0 < machine <= len(meter.arr_washes):
             raise ValueError("User wrong value!")
-    except ValueError:
+    except (ValueError, IndexError):
         logger.error(f"Invalid machine number provided by user {message.from_user.id}: {command.args}")
         await message.answer(
             "Ошибка: неправильный формат команды. Пример:\n"
-            "/setalarm <number-wash-machine>"
+            "/setalert <number-wash-machine> [site]"
         )
         return
 
-    text = pin(machine-1, message.from_user.id)
+    text = await pin(meter.site.site_id, machine-1, message.from_user.id)
     await message.answer(
         text
     )
 
+@dp.message(Command("any"))
+@log_function(logger)
+async def cmd_any(message: Message, command: CommandObject):
+    logger.info(f"Any machine queue requested by user {message.from_user.id}")
+    meter = main_sys.get(command.args.strip()) if command.args else main_sys.default
+    if meter is None:
+        await message.answer("Ошибка: нет такой прачечной. Пример:\n/any [site]")
+        return
+    await meter.getData()
+    free = [i for i, item in enumerate(meter.arr_washes) if not item.status]
+    if free:
+        # Ждать нечего: очередь только для тех, кому сейчас не хватило машинки
+        await message.answer("Сейчас свободны: " + ", ".join(machine_title(meter, i) for i in free) + ". Можно идти!")
+        return
+    position = await waits.join(meter.site.site_id, str(message.from_user.id))
+    await message.answer(
+        f"{queue_title(meter)}: вы #{position} в очереди.\n"
+        "Когда машинка освободится, я предложу её первому в очереди, а если он не успеет — следующему."
+    )
+
+@dp.callback_query(TakeAction.filter())
+@log_function(logger)
+async def take_machine(callback: types.CallbackQuery, callback_data: TakeAction):
+    logger.info(f"User {callback.from_user.id} takes machine #{callback_data.num} on site {callback_data.site}")
+    user_id = str(callback.from_user.id)
+    if await waits.claim(callback_data.site, callback_data.num, user_id):
+        text = "Машинка ваша, удачной стирки!"
+    else:
+        # Машинку заняли мимо очереди — место в очереди за пользователем сохранено
+        position, = await waits.positions([callback_data.site], user_id)
+        text = (f"Машинку уже заняли, вы снова #{position} в очереди" if position is not None
+                else "Время вышло, машинку предложили следующему в очереди")
+    await callback.answer(text=text, show_alert=True)
+
 @dp.message(Command("subscribers"))
 @log_function(logger)
 async def cmd_subscribers(message: Message):
@@ -173,33 +333,84 @@ async def cmd_subscribers(message: Message):
     logger.info(f"Subscriber list requested by admin {message.from_user.id}")
     
     # Get subscribers for each machine
-    subscriber_data = []
-    for i in range(6):
-        users = redis_db.get_by_num(i)
-        subscriber_data.append({
-            "machine_num": i+1,
-            "user_count": len(users),
-            "users": users
-        })
+    machines = all_machines()
+    counts = await redis_db.count_many([(meter.site.site_id, i) for meter, i in machines])
+    subscriber_data = [
+        {
+            "site": meter.site.site_id,
+            "wash_id": i,
+            "machine": machine_title(meter, i),
+            "user_count": count,
+        }
+        for (meter, i), count in zip(machines, counts)
+    ]
     
     # Format response
     content = as_list(
         Bold("📊 WASHING MACHINE SUBSCRIBERS 📊"),
-        *[f"Machine #{item['machine_num']}: {item['user_count']} subscribers" for item in subscriber_data],
+        *[f"Machine {item['machine']}: {item['user_count']} subscribers" for item in subscriber_data],
         sep="\n",
     )
     
     # Add detailed view option
     builder = InlineKeyboardBuilder()
-    for i in range(6):
-        if subscriber_data[i]['user_count'] > 0:
+    for item in subscriber_data:
+        if item['user_count'] > 0:
             builder.button(
-                text=f"Details for #{i+1}",
-                callback_data=AdminAction(user_id=message.from_user.id, wash_id=i).pack()
+                text=f"Details for {item['machine']}",
+                callback_data=AdminAction(user_id=message.from_user.id, site=item['site'], wash_id=item['wash_id']).pack()
             )
     
     await message.answer(**content.as_kwargs(), reply_markup=builder.as_markup())
 
+@dp.message(Command("notify_stats"))
+@log_function(logger)
+async def cmd_notify_stats(message: Message):
+    """Admin-only command to view notification delivery stats of this process"""
+    if message.from_user.id != settings.ADMIN_ID:
+        logger.info(f"Unauthorized notify stats request from user {message.from_user.id}")
+        return
+    
+    stats = delivery.stats()
+    content = as_list(
+        Bold("📨 NOTIFICATION DELIVERY 📨"),
+        *[f"{key}: {value:.3f}s" if key in ("p50", "p99") else f"{key}: {value}" for key, value in stats.items()],
+        sep="\n",
+    )
+    await message.answer(**content.as_kwargs())
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+@dp.message(Command("stats"))
+@log_function(logger)
+async def cmd_stats(message: Message):
+    """Admin-only command to view cycle and occupancy statistics from the precomputed aggregates"""
+    if message.from_user.id != settings.ADMIN_ID:
+        logger.info(f"Unauthorized stats request from user {message.from_user.id}")
+        return
+    
+    sections = []
+    for meter in main_sys:
+        machines, busiest = await history.site_stats(
+            redis_client, meter.site.site_id, [i + 1 for i in range(len(meter.arr_washes))]
+        )
+        sections.append(as_marked_section(
+            Bold(f"{meter.site.title}:"),
+            *[
+                f"{machine_title(meter, item.num - 1)}: {item.cycles} cycles"
+                + (f", avg {item.mean_cycle / 60:.0f} min, median ~{item.median_cycle / 60:.0f} min"
+                   if item.mean_cycle is not None and item.median_cycle is not None else "")
+                + f", busy {item.busy_24h:.0%} 24h / {item.busy_7d:.0%} 7d"
+                for item in machines
+            ],
+            "Busiest hours: " + (", ".join(
+                f"{WEEKDAYS[how // 24]} {how % 24:02d}:00 ({busy:.1f} busy)" for how, busy in busiest[:3]
+            ) or "no data yet"),
+            marker="  ",
+        ))
+    content = as_list(Bold("📈 MACHINE STATISTICS 📈"), *sections, sep="\n\n")
+    await message.answer(**content.as_kwargs())
+
 # Add handler for the admin callback
 @dp.callback_query(AdminAction.filter())
 @log_function(logger)
@@ -210,22 +421,43 @@ async def show_subscriber_details(callback: CallbackQuery, callback_data: AdminA
         return
     
     wash_id = callback_data.wash_id
-    users = redis_db.get_by_num(wash_id)
+    users = await redis_db.get_by_num(callback_data.site, wash_id)
     
     if not users:
         await callback.answer(f"No subscribers for machine #{wash_id+1}")
         return
     
-    text = f"📋 Subscribers for machine #{wash_id+1}:\n"
+    text = f"📋 Subscribers for machine #{wash_id+1} ({callback_data.site}):\n"
     for i, user_id in enumerate(users, 1):
         text += f"{i}. User ID: {user_id}\n"
     
     await callback.message.answer(text)
     await callback.answer()
 
+# Последний в списке: кнопки старых сообщений /status несут "<wash_id>_<user_id>" без сайта
+@dp.callback_query()
+@log_function(logger)
+async def legacy_callback(callback: types.CallbackQuery):
+    logger.info(f"Legacy callback {callback.data!r} received from user {callback.from_user.id}")
+    meter = main_sys.default
+    wash_id, _, _ = (callback.data or "").partition("_")
+    if not wash_id.isdigit() or int(wash_id) >= len(meter.arr_washes):
+        await callback.answer("Кнопка устарела, откройте /status заново")
+        return
+    text = await pin(meter.site.site_id, int(wash_id), callback.from_user.id)
+    await callback.message.answer(text)
+    await callback.answer(text=text, show_alert=True)
+
 async def main():
     logger.info("Starting main bot loop")
     await dp.start_polling(bot)
 
+def webhook_worker():
+    asyncio.run(webhook.serve(dp, bot))
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if settings.BOT_MODE == "webhook":
+        logger.info(f"Starting {settings.WEBHOOK_WORKERS} webhook worker(s)")
+        webhook.run_workers(webhook_worker, bot, dp)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,359 @@
+import asyncio, json, random, time, Usys, redis, settings
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+import redis.asyncio as aioredis
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+import eta, events, metrics
+from logger import setup_logger, log_function
+from snapshot import FORMAT_DT, Transition, cabinet_dt
+
+# Create logger for notifier
+logger = setup_logger('notifier')
+
+QUEUE_DEPTH = metrics.Gauge('notify_queue_depth', 'Messages waiting to be sent.')
+SEND_LATENCY = metrics.Histogram('notify_send_seconds', 'Time from enqueueing a message to Telegram accepting it.')
+SEND_RESULTS = metrics.Counter('notify_messages_total', 'Delivery outcomes.', ('result',))
+RATE_LIMITED = metrics.Counter('notify_rate_limited_total', '429 responses from Telegram.')
+ALERTS_MERGED = metrics.Counter('notify_alerts_merged_total',
+                                'Alerts sent as part of a combined per-user message instead of on their own.')
+WAIT_OFFERS = metrics.Counter('wait_offers_total', 'Free machines offered to "any machine" waiters.', ('reason',))
+
+
+class TakeAction(CallbackData, prefix="take"):
+    """Button of an "any free machine" offer: the waiter claims machine ``num`` (1-based)."""
+    site: str
+    num: int
+
+
+class TokenBucket:
+    """Token bucket refilled at ``rate`` tokens per second up to ``capacity``.
+
+    ``reserve`` always takes a token and returns how long the caller has to wait for it, so
+    concurrent callers queue up fairly instead of polling.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    @property
+    def idle(self) -> bool:
+        """True once the bucket would be full again, i.e. it can be forgotten."""
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class Delivery:
+    """One message waiting to be sent."""
+
+    __slots__ = ("chat_id", "text", "parse_mode", "reply_markup", "enqueued_at", "attempts", "future")
+
+    def __init__(self, chat_id: str, text: str, parse_mode: Optional[str], future: asyncio.Future,
+                 reply_markup: Optional[InlineKeyboardMarkup] = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.future = future
+
+
+class DeliveryQueue:
+    """Sends messages through the bot's session with bounded concurrency and Telegram rate limits.
+
+    A global and a per-chat token bucket keep us within Telegram's limits, ``retry_after`` of a 429
+    pauses every worker, network and server errors are retried with exponential backoff, and messages
+    that still fail are pushed to the ``notify_dead`` list.
+    """
+
+    DEAD_LETTER_KEY = 'notify_dead'
+
+    def __init__(self, bot: Bot, redis_db: aioredis.Redis, workers: int = settings.NOTIFY_WORKERS):
+        self.bot = bot
+        self.redis_db = redis_db
+        self.workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._global = TokenBucket(settings.NOTIFY_GLOBAL_RATE, settings.NOTIFY_GLOBAL_RATE)
+        self._chats: Dict[str, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._latencies: Deque[float] = deque(maxlen=1000)
+        self.counters: Dict[str, int] = dict(sent=0, retried=0, rate_limited=0, dropped=0, dead=0)
+
+    def _ensure_workers(self) -> asyncio.Queue:
+        # Created lazily so the queue belongs to the running loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self._queue
+
+    def submit(self, chat_id: str, text: str, parse_mode: Optional[str] = None,
+               reply_markup: Optional[InlineKeyboardMarkup] = None) -> asyncio.Future:
+        """Queue a message; the returned future resolves to True once sent, False if given up."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._ensure_workers()
+        queue.put_nowait(Delivery(chat_id, text, parse_mode, future, reply_markup))
+        QUEUE_DEPTH.set(queue.qsize())
+        return future
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def stats(self) -> Dict[str, float]:
+        """Delivery counters, queue depth and enqueue-to-sent latency percentiles in seconds."""
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return dict(self.counters, depth=self.depth, p50=percentile(0.5), p99=percentile(0.99))
+
+    async def _throttle(self, chat_id: str) -> None:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle}
+            bucket = self._chats[chat_id] = TokenBucket(settings.NOTIFY_CHAT_RATE, 1)
+        delay = max(bucket.reserve(), self._global.reserve(), self._paused_until - time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _worker(self) -> None:
+        while True:
+            delivery = await self._queue.get()
+            QUEUE_DEPTH.set(self._queue.qsize())
+            try:
+                sent = await self._deliver(delivery)
+            except Exception as e:
+                logger.error(f"Unexpected error delivering to chat {delivery.chat_id}: {str(e)}")
+                sent = False
+            finally:
+                self._queue.task_done()
+            if not delivery.future.done():
+                delivery.future.set_result(sent)
+
+    async def _deliver(self, delivery: Delivery) -> bool:
+        while True:
+            await self._throttle(delivery.chat_id)
+            try:
+                await self.bot.send_message(delivery.chat_id, delivery.text, parse_mode=delivery.parse_mode,
+                                            reply_markup=delivery.reply_markup)
+                self.counters['sent'] += 1
+                self._latencies.append(time.monotonic() - delivery.enqueued_at)
+                SEND_LATENCY.observe(self._latencies[-1])
+                SEND_RESULTS.inc('sent')
+                logger.info(f"Message sent successfully to chat {delivery.chat_id}")
+                return True
+            except TelegramRetryAfter as e:
+                self.counters['rate_limited'] += 1
+                RATE_LIMITED.inc()
+                logger.warning(f"Rate limited by Telegram, pausing deliveries for {e.retry_after}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            except TelegramForbiddenError as e:
+                # The user blocked the bot: nothing to retry
+                self.counters['dropped'] += 1
+                SEND_RESULTS.inc('dropped')
+                logger.info(f"Chat {delivery.chat_id} is unreachable: {e.message}")
+                return False
+            except TelegramBadRequest as e:
+                await self._dead_letter(delivery, str(e))
+                return False
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                delivery.attempts += 1
+                if delivery.attempts >= settings.NOTIFY_MAX_ATTEMPTS:
+                    await self._dead_letter(delivery, str(e))
+                    return False
+                self.counters['retried'] += 1
+                SEND_RESULTS.inc('retried')
+                backoff = settings.NOTIFY_BACKOFF * 2 ** (delivery.attempts - 1)
+                logger.warning(f"Error sending message to chat {delivery.chat_id} ({str(e)}), retrying in {backoff:.1f}s")
+                await asyncio.sleep(backoff * random.uniform(1, 1.5))
+
+    async def _dead_letter(self, delivery: Delivery, error: str) -> None:
+        self.counters['dead'] += 1
+        SEND_RESULTS.inc('dead')
+        logger.error(f"Giving up on message to chat {delivery.chat_id}: {error}")
+        try:
+            async with self.redis_db.pipeline(transaction=False) as pipe:
+                pipe.lpush(self.DEAD_LETTER_KEY, json.dumps(dict(
+                    chat_id=delivery.chat_id, text=delivery.text, parse_mode=delivery.parse_mode,
+                    error=error, attempts=delivery.attempts, ts=int(time.time()),
+                ), ensure_ascii=False))
+                pipe.ltrim(self.DEAD_LETTER_KEY, 0, settings.NOTIFY_DEAD_LETTER_MAX - 1)
+                await pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Could not store dead letter for chat {delivery.chat_id}: {str(e)}")
+
+
+class Notifier:
+    """Alerts the subscribers of a machine when its status changes.
+
+    Changes of one site's poll cycle arrive together; a user subscribed to several of the changed
+    machines gets a single message about all of them. Sites are committed separately, so a user
+    subscribed in two laundries still gets one message per laundry.
+
+    A freed machine is also offered to the first "any free machine" waiter of its site only;
+    ``run_sweeper`` passes offers that were not claimed in time on to the next waiter.
+    """
+
+    def __init__(self, delivery: DeliveryQueue, users: Usys.RedisUser, sites: Optional[List[Usys.Site]] = None,
+                 estimator: Optional[eta.Estimator] = None):
+        self.delivery = delivery
+        self.users = users
+        self.waits = Usys.WaitQueue(users.redis_db)
+        self.estimator = estimator or eta.Estimator(users.redis_db)
+        sites = Usys.load_sites() if sites is None else sites
+        self.site_ids = [site.site_id for site in sites]
+        # Site titles are only shown when several laundries are served
+        self.titles = {site.site_id: site.title for site in sites} if len(sites) > 1 else {}
+
+    def site_prefix(self, site_id: str) -> str:
+        return f"{self.titles[site_id]}: " if site_id in self.titles else ""
+
+    def change_line(self, transition: Transition) -> str:
+        num = transition.num
+        eta_ts = self.estimator.eta(transition.site_id, num, transition.upd_ts) if transition.status else None
+        eta_info = f'\n⏳ {eta.describe(eta_ts)}' if eta_ts is not None else ""
+        return (f'🧻№{num}  - *{"‼️BUSY‼️" if transition.old_status else "✅Free"}* изменился на '
+                f'*{"‼️BUSY‼️" if transition.status else "✅Free"}*{eta_info}')
+
+    def alert_text(self, transition: Transition) -> str:
+        upd_dt = cabinet_dt(transition.upd_ts).strftime(FORMAT_DT)
+        return (f"*🔔 - {self.site_prefix(transition.site_id)}🧻№{transition.num} Изменилась*\n"
+                f'{self.change_line(transition)}\n\t'
+                f'\nДата обновления: {upd_dt}')
+
+    def batch_text(self, transitions: List[Transition]) -> str:
+        """One message about several machines of a site that changed in the same poll cycle."""
+        if len(transitions) == 1:
+            return self.alert_text(transitions[0])
+        upd_dt = cabinet_dt(max(t.upd_ts for t in transitions)).strftime(FORMAT_DT)
+        lines = "\n".join(self.change_line(t) for t in transitions)
+        return (f"*🔔 - {self.site_prefix(transitions[0].site_id)}Изменились стиралки: {len(transitions)}*\n"
+                f"{lines}\n\t"
+                f"\nДата обновления: {upd_dt}")
+
+    @log_function(logger)
+    async def react(self, event_id: str, transitions: List[Transition]) -> None:
+        for transition in transitions:
+            logger.info(f"Reacting to status change for machine #{transition.num} on site {transition.site_id}: "
+                        f"{transition.old_status} -> {transition.status}")
+        await self.estimator.refresh(self.site_ids)
+        # Subscribers stay claimed under the event id until the fan-out is done, so a redelivered
+        # event reaches the same users and nobody is lost between pop and send
+        claimed = await asyncio.gather(*[
+            self.users.pop_by_num(transition.site_id, transition.num - 1, claim_id=event_id)
+            for transition in transitions
+        ])
+        changes: Dict[str, List[Transition]] = {}
+        for transition, users in zip(transitions, claimed):
+            for user_id in users:
+                changes.setdefault(user_id, []).append(transition)
+        await asyncio.gather(*[
+            self.delivery.submit(user_id, self.batch_text(user_changes), ParseMode.MARKDOWN)
+            for user_id, user_changes in changes.items()
+        ])
+        alerts = sum(len(users) for users in claimed)
+        if alerts > len(changes):
+            ALERTS_MERGED.inc(amount=alerts - len(changes))
+            logger.info(f"Sent {alerts} alerts as {len(changes)} messages, saved {alerts - len(changes)} API calls")
+        await asyncio.gather(*[
+            self.users.release_claim(event_id, transition.site_id, transition.num - 1) for transition in transitions
+        ])
+
+        for transition in transitions:
+            if transition.old_status and not transition.status:
+                user_id = await self.waits.wake(transition.site_id, transition.num)
+                if user_id is not None:
+                    WAIT_OFFERS.inc("freed")
+                    await self.offer(transition.site_id, transition.num, user_id)
+            elif transition.status and not transition.old_status:
+                user_id = await self.waits.resolve(transition.site_id, transition.num)
+                if user_id is not None:
+                    WAIT_OFFERS.inc("taken")
+                    await self.delivery.submit(
+                        user_id,
+                        f"{self.site_prefix(transition.site_id)}🧻№{transition.num} заняли раньше вас. "
+                        f"Ваше место в очереди сохранено, предложу следующую свободную машинку.",
+                    )
+
+    def offer_text(self, site_id: str, num: int) -> str:
+        return (f"*✅ {self.site_prefix(site_id)}🧻№{num} свободна!*\n"
+                f"Вы первый в очереди на любую машинку. Нажмите «Беру», иначе через "
+                f"{max(1, round(settings.WAIT_CLAIM_TIMEOUT / 60))} мин её предложат следующему.")
+
+    async def offer(self, site_id: str, num: int, user_id: str) -> None:
+        builder = InlineKeyboardBuilder()
+        builder.button(text="🏃 Беру", callback_data=TakeAction(site=site_id, num=num))
+        logger.info(f"Offering machine #{num} on site {site_id} to waiter {user_id}")
+        await self.delivery.submit(user_id, self.offer_text(site_id, num), ParseMode.MARKDOWN, builder.as_markup())
+
+    async def run_sweeper(self) -> None:
+        """Pass unclaimed offers on to the next waiters until the task is cancelled."""
+        while True:
+            try:
+                for site_id in self.site_ids:
+                    for num, user_id in await self.waits.sweep(site_id):
+                        WAIT_OFFERS.inc("passed")
+                        await self.offer(site_id, num, user_id)
+            except asyncio.CancelledError:
+                raise
+            except redis.RedisError as e:
+                logger.error(f"Wait queue sweep Redis error: {str(e)}")
+            await asyncio.sleep(settings.WAIT_SWEEP_INTERVAL)
+
+
+def create_consumer(delivery: DeliveryQueue, users: Usys.RedisUser,
+                    notifier: Optional[Notifier] = None) -> events.EventConsumer:
+    """Event consumer that notifies subscribers through ``delivery``."""
+    return events.EventConsumer(Usys.redis_client(), (notifier or Notifier(delivery, users)).react)
+
+
+async def main():
+    logger.info("Starting dedicated notifier worker")
+    bot = Bot(token=settings.BOT_TOKEN)
+    redis_db = Usys.redis_client()
+    delivery = DeliveryQueue(bot, redis_db)
+    notifier = Notifier(delivery, Usys.RedisUser(redis_db))
+    consumer = create_consumer(delivery, notifier.users, notifier)
+    metrics_runner = await metrics.start_server()
+    try:
+        await asyncio.gather(consumer.run(), notifier.run_sweeper())
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await delivery.close()
+        await bot.session.close()
+        await Usys.close_redis()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
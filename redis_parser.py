@@ -1,7 +1,7 @@
-import asyncio, logging, Usys, redis, settings
-import time
+import asyncio, leader, metrics, signal, Usys, settings
+from scheduler import PollScheduler
+from typing import Optional
 
-import requests
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
@@ -12,11 +12,9 @@ from aiogram.utils.formatting import (
 from logger import setup_logger, log_function
 
 USER_ID = settings.ADMIN_ID
-main_sys = Usys.UniMeter(redis_db=redis.StrictRedis(**settings.REDIS_DB), server_mode=True)
-
-redis_db = Usys.RedisUser(redis_db=redis.StrictRedis(**settings.REDIS_DB))
-
-logging.basicConfig(level=logging.INFO)
+# Реплик может быть несколько: сайт опрашивает и пишет в Redis только держатель аренды
+lease = leader.LeaderLease(Usys.redis_client())
+main_sys = Usys.SiteRegistry(redis_db=Usys.redis_client(), server_mode=True, lease=lease)
 
 bot = Bot(token=settings.BOT_TOKEN)
 dp = Dispatcher()
@@ -24,15 +22,31 @@ dp = Dispatcher()
 # Создаем logger для redis_parser
 logger = setup_logger('redis_parser')
 
+poll_task: Optional[asyncio.Task] = None
+dp.message.middleware(metrics.handler_middleware)
+
 @dp.startup()
 @log_function(logger)
 async def on_startup(*args, **kwargs):
+    global poll_task
     logger.info("Bot starting up...")
+    await main_sys.prepare()
     await bot.send_message(USER_ID, "bot started!<3")
-    while True:
-        logger.info("Fetching washing machine data...")
-        main_sys.getData()
-        time.sleep(10)
+    scheduler = PollScheduler(Usys.redis_client()) if settings.POLL_ADAPTIVE else None
+    poll_task = asyncio.create_task(main_sys.run_forever(settings.POLL_INTERVAL, scheduler))
+
+
+@dp.shutdown()
+@log_function(logger)
+async def on_shutdown(*args, **kwargs):
+    logger.info("Bot shutting down, stopping poller...")
+    if poll_task is not None:
+        poll_task.cancel()
+        try:
+            await poll_task
+        except asyncio.CancelledError:
+            pass
+    await main_sys.close()
 
 
 @dp.message(Command("admin_stat"))
@@ -42,37 +56,24 @@ async def cmd_start(message: types.Message):
     await message.answer("Приветики! \n ")
 
 
-def send_message(chat_id, text, token=settings.BOT_TOKEN):
-    base_url = f"https://api.telegram.org/bot{token}/sendMessage"
-    params = {
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode': 'markdown'
-    }
-
-    try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()
-        logger.info(f"Message sent successfully to chat {chat_id}")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending message to chat {chat_id}: {e}")
-
-@log_function(logger)
-def react(num, status, old_status, upd_dt, old_upd_dt):
-    logger.info(f"Reacting to status change for machine #{num}: {old_status} -> {status}")
-    for data in redis_db.pop_by_num(num-1):
-        send_message(data, f"*🔔 - 🧻№{num} Изменилась*\n"
-                     f'🧻№{num}  - *{"‼️BUSY‼️" if old_status else "✅Free"}* изменился на *{"‼️BUSY‼️" if status else "✅Free"}*\n\t'
-                     f'\nДата обновления: {upd_dt}')
-
-
-
 async def main():
     logger.info("Starting redis_parser main loop")
-    await dp.start_polling(bot)
+    metrics_runner = await metrics.start_server()
+    # Резервные реплики ждут здесь; сайт и Telegram опрашивает только лидер
+    # Опрос Telegram останавливаем через stop_polling: отмена задачи оставляет внутренние поллеры aiogram
+    elector = leader.LeaderElector(lease, healthy=main_sys.poll_healthy, stop=dp.stop_polling)
+    election = asyncio.create_task(elector.run(lambda: dp.start_polling(bot, handle_signals=False)))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, election.cancel)
+    try:
+        await election
+    except asyncio.CancelledError:
+        logger.info("redis_parser stopped")
+    finally:
+        await Usys.close_redis()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == '__main__':
-    logger.info("Setting up alert functions for all washing machines")
-    for item in main_sys.arr_washes:
-        item.alert_func = react
     asyncio.run(main())
@@ -0,0 +1,110 @@
+import random, time
+from typing import Iterable, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+import eta, metrics, settings, Usys
+from logger import setup_logger
+from snapshot import cabinet_dt
+
+# Create logger for scheduler
+logger = setup_logger('scheduler')
+
+POLL_DELAY = metrics.Gauge('unimeter_poll_interval_seconds', 'Delay chosen before the next poll.')
+
+
+def parse_hours(value: str) -> Optional[Tuple[int, int]]:
+    """``"1-7"`` -> (1, 7); the range may wrap around midnight, e.g. ``"23-6"``."""
+    if not value:
+        return None
+    start, end = value.split("-", 1)
+    return int(start) % 24, int(end) % 24
+
+
+class PollScheduler:
+    """Chooses the delay before the next poll from the board, the subscriptions and the clock.
+
+    * a busy machine within ``POLL_NEAR_ETA`` seconds of its expected end, or a subscribed machine
+      we cannot estimate, is polled every ``POLL_MIN_INTERVAL`` seconds; in quiet hours only if
+      somebody is subscribed to it;
+    * subscribers waiting on machines far from their end keep the base ``POLL_INTERVAL``;
+    * with nobody waiting, quiet hours poll every ``POLL_MAX_INTERVAL`` seconds, and an idle
+      board (nothing busy) backs off from the base interval by ``POLL_BACKOFF`` per cycle;
+    * every delay gets ``±POLL_JITTER`` of random jitter.
+    """
+
+    def __init__(self, redis_db: aioredis.Redis, estimator: Optional[eta.Estimator] = None,
+                 base: float = settings.POLL_INTERVAL, min_interval: float = settings.POLL_MIN_INTERVAL,
+                 max_interval: float = settings.POLL_MAX_INTERVAL, jitter: float = settings.POLL_JITTER,
+                 quiet_hours: Optional[Tuple[int, int]] = parse_hours(settings.POLL_QUIET_HOURS)):
+        self.redis_db = redis_db
+        self.estimator = estimator or eta.Estimator(redis_db)
+        self.base = base
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.quiet_hours = quiet_hours
+        self._idle_interval = base
+        self.mode = "base"
+
+    def is_quiet(self, now: float) -> bool:
+        if self.quiet_hours is None:
+            return False
+        start, end = self.quiet_hours
+        hour = cabinet_dt(now).hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    async def _subscribed(self, meters: Iterable["Usys.UniMeter"]) -> set:
+        """``(site, num)`` of every machine somebody is waiting on, in one round trip."""
+        machines = [(meter.site.site_id, state.num) for meter in meters for state in meter.snapshot]
+        if not machines:
+            return set()
+        async with self.redis_db.pipeline(transaction=False) as pipe:
+            for site_id, num in machines:
+                pipe.exists(Usys.RedisUser.name_db(site_id, num - 1))
+            flags = await pipe.execute()
+        return {machine for machine, flag in zip(machines, flags) if flag}
+
+    async def next_interval(self, meters: Iterable["Usys.UniMeter"], now: Optional[float] = None) -> float:
+        meters = list(meters)
+        now = time.time() if now is None else now
+        await self.estimator.refresh([meter.site.site_id for meter in meters])
+        subscribed = await self._subscribed(meters)
+        busy = near = near_waited = unknown = False
+        for meter in meters:
+            predictions = self.estimator.predict(meter.snapshot)
+            for state in meter.snapshot:
+                if not state.status:
+                    continue
+                busy = True
+                end = predictions.get(state.num)
+                waited = (meter.site.site_id, state.num) in subscribed
+                if end is None:
+                    unknown = unknown or waited
+                elif abs(now - end) <= settings.POLL_NEAR_ETA:
+                    # A machine long past its estimate is stuck or mis-estimated, not about to end
+                    near = True
+                    near_waited = near_waited or waited
+
+        quiet = self.is_quiet(now)
+        if unknown or near_waited or (near and not quiet):
+            mode, interval = "urgent", self.min_interval
+        elif subscribed:
+            mode, interval = "waiting", self.base
+        elif quiet:
+            mode, interval = "quiet", self.max_interval
+        elif not busy:
+            mode, interval = "idle", self._idle_interval
+        else:
+            mode, interval = "base", self.base
+        # Back off further with every idle cycle, start over as soon as something happens
+        self._idle_interval = min(self.max_interval, self._idle_interval * settings.POLL_BACKOFF) \
+            if mode == "idle" else self.base
+        if mode != self.mode:
+            logger.info(f"Polling mode {self.mode} -> {mode}")
+            self.mode = mode
+
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        POLL_DELAY.set(interval)
+        return interval
@@ -1,4 +1,6 @@
+import json
 import os
+import sys
 REDIS_DB: dict = dict(
         host="redis.arefaste",
         port=6379,
@@ -6,6 +8,158 @@ REDIS_DB: dict = dict(
         password=None,
 )
 
+# Size of the asyncio Redis connection pool shared by everything in a process; when all connections
+# are busy a command waits up to REDIS_POOL_TIMEOUT seconds for one
+REDIS_POOL_SIZE: int = int(os.getenv("REDIS_POOL_SIZE", 20))
+REDIS_POOL_TIMEOUT: float = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+
 BOT_TOKEN: str = os.getenv("bot_token")
 
-ADMIN_ID: int = 504467583
\ No newline at end of file
+ADMIN_ID: int = 504467583
+
+# Local Prometheus endpoint of each process (/metrics); port 0 disables it
+METRICS_HOST: str = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT: int = int(os.getenv("METRICS_PORT", 9100))
+
+# Interval between two polls of the UniMetriq cabinet, seconds
+POLL_INTERVAL: float = float(os.getenv("POLL_INTERVAL", 10))
+
+# Adaptive polling: POLL_MIN_INTERVAL while a machine is near its expected end, up to POLL_MAX_INTERVAL
+# when idle (growing by POLL_BACKOFF per cycle) or in quiet hours ("1-7", local time, empty to disable).
+# Set POLL_ADAPTIVE=0 to poll every POLL_INTERVAL seconds.
+POLL_ADAPTIVE: bool = os.getenv("POLL_ADAPTIVE", "1") == "1"
+POLL_MIN_INTERVAL: float = float(os.getenv("POLL_MIN_INTERVAL", 5))
+POLL_MAX_INTERVAL: float = float(os.getenv("POLL_MAX_INTERVAL", 120))
+POLL_BACKOFF: float = float(os.getenv("POLL_BACKOFF", 1.5))
+POLL_JITTER: float = float(os.getenv("POLL_JITTER", 0.1))
+POLL_NEAR_ETA: float = float(os.getenv("POLL_NEAR_ETA", 300))
+POLL_QUIET_HOURS: str = os.getenv("POLL_QUIET_HOURS", "2-7")
+
+# Scraper replicas elect a leader through a Redis lease renewed every LEADER_TTL/3 seconds. A dead
+# leader is replaced within LEADER_TTL * 4/3 (keep it below POLL_INTERVAL), a leader whose poll cycle
+# runs longer than LEADER_POLL_TIMEOUT stops renewing and is replaced as well (keep it above a fetch
+# with all its retries, see UPSTREAM_*).
+LEADER_TTL: float = float(os.getenv("LEADER_TTL", 7))
+LEADER_POLL_TIMEOUT: float = float(os.getenv("LEADER_POLL_TIMEOUT", 60))
+
+# HTTP connection pool towards the UniMetriq cabinet
+UPSTREAM_POOL_SIZE: int = int(os.getenv("UPSTREAM_POOL_SIZE", 10))
+UPSTREAM_KEEPALIVE: float = float(os.getenv("UPSTREAM_KEEPALIVE", 60))
+UPSTREAM_PER_HOST_LIMIT: int = int(os.getenv("UPSTREAM_PER_HOST_LIMIT", 4))
+# Upstream timeouts in seconds: connecting, waiting for data, and the whole request
+UPSTREAM_CONNECT_TIMEOUT: float = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_READ_TIMEOUT: float = float(os.getenv("UPSTREAM_READ_TIMEOUT", 8))
+UPSTREAM_TIMEOUT: float = float(os.getenv("UPSTREAM_TIMEOUT", 12))
+# Failed requests (errors, timeouts, 5xx) are retried UPSTREAM_RETRIES times after a jittered
+# UPSTREAM_BACKOFF * 2^n seconds
+UPSTREAM_RETRIES: int = int(os.getenv("UPSTREAM_RETRIES", 2))
+UPSTREAM_BACKOFF: float = float(os.getenv("UPSTREAM_BACKOFF", 1))
+# After UPSTREAM_BREAKER_FAILURES failed fetches in a row a site is not polled for
+# UPSTREAM_BREAKER_COOLDOWN seconds, doubled after every failed trial up to UPSTREAM_BREAKER_MAX_COOLDOWN
+UPSTREAM_BREAKER_FAILURES: int = int(os.getenv("UPSTREAM_BREAKER_FAILURES", 3))
+UPSTREAM_BREAKER_COOLDOWN: float = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", 60))
+UPSTREAM_BREAKER_MAX_COOLDOWN: float = float(os.getenv("UPSTREAM_BREAKER_MAX_COOLDOWN", 600))
+# /status marks a board as outdated when its last successful fetch is older than this, seconds
+STALE_AFTER: float = float(os.getenv("STALE_AFTER", 300))
+
+# Laundries served by this deployment: site id -> cabinet url or {"url": ..., "title": ...}.
+# Override with a JSON object in the UNIMETER_SITES environment variable.
+SITES: dict = json.loads(os.getenv("UNIMETER_SITES", "null")) or {
+        "main": {
+                "url": "https://cabinet.unimetriq.com/client/6703b4b333805792cfa639770058bd45",
+                "title": "Прачечная",
+        },
+}
+
+# Time zone of the cabinet: page times are read in it, and times shown to users, hours of the day
+# and quiet hours use it as well, whatever the zone of the container
+CABINET_TZ: str = os.getenv("CABINET_TZ", "Europe/Moscow")
+
+# HTML parser used to read cabinet pages: "lxml" (falls back to "bs4" when lxml is missing) or "bs4"
+PARSER_BACKEND: str = os.getenv("PARSER_BACKEND", "lxml")
+
+# Redis Stream carrying status transitions from the scraper to the notifiers
+EVENTS_MAXLEN: int = int(os.getenv("EVENTS_MAXLEN", 10000))
+EVENTS_BATCH: int = int(os.getenv("EVENTS_BATCH", 50))
+EVENTS_BLOCK_MS: int = int(os.getenv("EVENTS_BLOCK_MS", 5000))
+EVENTS_CLAIM_IDLE_MS: int = int(os.getenv("EVENTS_CLAIM_IDLE_MS", 60000))
+EVENTS_MAX_DELIVERIES: int = int(os.getenv("EVENTS_MAX_DELIVERIES", 5))
+EVENTS_CONSUMER_TTL_MS: int = int(os.getenv("EVENTS_CONSUMER_TTL_MS", 24 * 3600 * 1000))
+
+# Transition history and occupancy aggregates: raw history is trimmed by age and length, hourly
+# buckets are downsampled into daily ones, which are kept for about a year
+HISTORY_RETENTION_DAYS: int = int(os.getenv("HISTORY_RETENTION_DAYS", 30))
+HISTORY_MAX_ENTRIES: int = int(os.getenv("HISTORY_MAX_ENTRIES", 5000))
+OCCUPANCY_HOURLY_DAYS: int = int(os.getenv("OCCUPANCY_HOURLY_DAYS", 14))
+OCCUPANCY_DAILY_DAYS: int = int(os.getenv("OCCUPANCY_DAILY_DAYS", 400))
+# Longer busy intervals are gaps in polling, not washing cycles, seconds
+CYCLE_MAX_SECONDS: int = int(os.getenv("CYCLE_MAX_SECONDS", 6 * 3600))
+
+# "Likely free at" estimates: cycle statistics are kept per part of the day of ETA_BUCKET_HOURS hours
+# (changing it mixes up the stored statistics), used after ETA_MIN_SAMPLES cycles and reloaded
+# every ETA_REFRESH seconds
+ETA_BUCKET_HOURS: int = int(os.getenv("ETA_BUCKET_HOURS", 3))
+ETA_MIN_SAMPLES: int = int(os.getenv("ETA_MIN_SAMPLES", 3))
+ETA_REFRESH: float = float(os.getenv("ETA_REFRESH", 300))
+
+# Rendered /status is kept until the scraper announces a new board, but never longer than this, seconds
+RENDER_CACHE_MAX_AGE: float = float(os.getenv("RENDER_CACHE_MAX_AGE", 60))
+
+# Consume transitions inside the bot process; disable when dedicated notifier.py workers run
+NOTIFY_IN_BOT: bool = os.getenv("NOTIFY_IN_BOT", "1") == "1"
+
+# Notification delivery: concurrent senders and Telegram limits (messages per second)
+NOTIFY_WORKERS: int = int(os.getenv("NOTIFY_WORKERS", 8))
+NOTIFY_GLOBAL_RATE: float = float(os.getenv("NOTIFY_GLOBAL_RATE", 25))
+NOTIFY_CHAT_RATE: float = float(os.getenv("NOTIFY_CHAT_RATE", 1))
+NOTIFY_MAX_ATTEMPTS: int = int(os.getenv("NOTIFY_MAX_ATTEMPTS", 5))
+NOTIFY_BACKOFF: float = float(os.getenv("NOTIFY_BACKOFF", 1))
+NOTIFY_DEAD_LETTER_MAX: int = int(os.getenv("NOTIFY_DEAD_LETTER_MAX", 1000))
+
+# How long popped subscribers are kept for redelivery if the notifier dies mid fan-out, seconds
+CLAIM_TTL: int = int(os.getenv("CLAIM_TTL", 24 * 3600))
+
+# "Any free machine" queue: seconds a woken waiter has to claim the machine before the next one is woken,
+# how often expired offers are swept, and how long somebody may wait before being dropped from the queue
+WAIT_CLAIM_TIMEOUT: float = float(os.getenv("WAIT_CLAIM_TIMEOUT", 180))
+WAIT_SWEEP_INTERVAL: float = float(os.getenv("WAIT_SWEEP_INTERVAL", 5))
+WAIT_MAX_AGE: float = float(os.getenv("WAIT_MAX_AGE", 3 * 3600))
+
+# How the bot receives updates: "polling" from one process, or "webhook" served by WEBHOOK_WORKERS
+# processes sharing WEBHOOK_PORT. WEBHOOK_URL is the public https base Telegram posts to, and every
+# request must carry WEBHOOK_SECRET. Each worker N logs to <process>-N and serves metrics on METRICS_PORT+N.
+BOT_MODE: str = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST: str = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS: int = int(os.getenv("WEBHOOK_WORKERS", 2))
+WEBHOOK_MAX_CONNECTIONS: int = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# An update is claimed by one worker for UPDATE_CLAIM_TTL seconds while it is handled and remembered
+# for UPDATE_DEDUP_TTL seconds once done, so redeliveries to another worker are dropped
+UPDATE_CLAIM_TTL: int = int(os.getenv("UPDATE_CLAIM_TTL", 60))
+UPDATE_DEDUP_TTL: int = int(os.getenv("UPDATE_DEDUP_TTL", 24 * 3600))
+
+# Token buckets as "<tokens per second>/<burst>": for every request of a user, per user and command, and
+# per command across all users. Commands are named like "status" or "clear"; "pin" is the machine buttons.
+THROTTLE_ENABLED: bool = os.getenv("THROTTLE_ENABLED", "1") == "1"
+THROTTLE_USER: str = os.getenv("THROTTLE_USER", "1/10")
+THROTTLE_COMMANDS: str = os.getenv("THROTTLE_COMMANDS", "status=0.5/4,pin=0.5/4,setalert=0.5/4,any=0.2/2,clear=0.2/2,start=0.2/2")
+THROTTLE_GLOBAL: str = os.getenv("THROTTLE_GLOBAL", "pin=20/100,setalert=20/100")
+
+# Logging: root level, per-module overrides like "Usys=DEBUG,aiogram=WARNING" and file rotation.
+# Every process writes to its own LOG_DIR/<process> directory, since ./logs is shared by the containers.
+LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS: dict = dict(
+        item.split("=", 1) for item in os.getenv("LOG_LEVELS", "").replace(" ", "").split(",") if "=" in item
+)
+LOG_DIR: str = os.path.join(
+        os.getenv("LOG_DIR", "logs"),
+        os.getenv("LOG_PROCESS") or os.path.splitext(os.path.basename(sys.argv[0] or "app"))[0] or "app",
+)
+LOG_MAX_BYTES: int = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_ROTATE_WHEN: str = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_BACKUPS: int = int(os.getenv("LOG_BACKUPS", 14))
+LOG_QUEUE_SIZE: int = int(os.getenv("LOG_QUEUE_SIZE", 10000))
@@ -0,0 +1,103 @@
+import datetime, time, zoneinfo
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import settings
+
+FORMAT_DT = "%d.%m.%Y в %H:%M"
+# Zone of the wall-clock times shown by the cabinet
+CABINET_TZ = zoneinfo.ZoneInfo(settings.CABINET_TZ)
+
+
+class MachineState(NamedTuple):
+    """State of one machine: busy flag and epoch of the last status change."""
+    num: int
+    status: bool
+    upd_ts: int
+
+
+class Transition(NamedTuple):
+    """Status change of one machine between two snapshots."""
+    site_id: str
+    num: int
+    status: bool
+    old_status: bool
+    upd_ts: int
+    old_upd_ts: int
+
+
+class BoardSnapshot:
+    """Immutable state of a whole site board at a given version."""
+
+    __slots__ = ("site_id", "version", "machines", "fetched_at")
+
+    def __init__(self, site_id: str, version: int, machines: Dict[int, MachineState],
+                 fetched_at: Optional[float] = None):
+        object.__setattr__(self, "site_id", site_id)
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "machines", dict(sorted(machines.items())))
+        object.__setattr__(self, "fetched_at", fetched_at)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("BoardSnapshot is immutable")
+
+    def __len__(self) -> int:
+        return len(self.machines)
+
+    def __iter__(self):
+        return iter(self.machines.values())
+
+    def get(self, num: int) -> Optional[MachineState]:
+        return self.machines.get(num)
+
+    def __repr__(self) -> str:
+        return f"BoardSnapshot({self.site_id!r}, v{self.version}, {len(self.machines)} machines)"
+
+
+def empty_snapshot(site_id: str) -> BoardSnapshot:
+    return BoardSnapshot(site_id, 0, {})
+
+
+_last_parsed: Tuple[Optional[str], int] = (None, 0)
+
+
+def parse_upd_ts(upd_dt: str) -> int:
+    """Convert the page's "dd.mm.YYYY в HH:MM" update time to epoch seconds, once per distinct value."""
+    global _last_parsed
+    if _last_parsed[0] != upd_dt:
+        parsed = datetime.datetime.strptime(upd_dt, FORMAT_DT).replace(tzinfo=CABINET_TZ)
+        _last_parsed = (upd_dt, int(parsed.timestamp()))
+    return _last_parsed[1]
+
+
+def cabinet_dt(ts: float) -> datetime.datetime:
+    """Epoch as the cabinet's wall-clock time."""
+    return datetime.datetime.fromtimestamp(ts, CABINET_TZ)
+
+
+def diff(prev: BoardSnapshot, readings: Iterable[Tuple[int, bool]], upd_ts: int,
+         fetched_at: Optional[float] = None) -> Tuple[BoardSnapshot, List[MachineState], List[Transition]]:
+    """Diff page readings ``(num, busy)`` against the previous snapshot.
+
+    A machine changes only when both its busy flag and the page update time differ from the stored
+    ones. Machines seen for the first time are stored without a transition, so a fresh or restarted
+    backend never alerts on them. Returns the new snapshot (version bumped only if something
+    changed), the states to write and the transitions to announce.
+    """
+    machines = dict(prev.machines)
+    changed: List[MachineState] = []
+    transitions: List[Transition] = []
+    for num, status in readings:
+        old = machines.get(num)
+        if old is None:
+            state = MachineState(num, status, upd_ts)
+        elif old.status != status and old.upd_ts != upd_ts:
+            state = MachineState(num, status, upd_ts)
+            transitions.append(Transition(prev.site_id, num, status, old.status, upd_ts, old.upd_ts))
+        else:
+            continue
+        machines[num] = state
+        changed.append(state)
+    fetched_at = time.time() if fetched_at is None else fetched_at
+    if not changed:
+        return BoardSnapshot(prev.site_id, prev.version, prev.machines, fetched_at), changed, transitions
+    return BoardSnapshot(prev.site_id, prev.version + 1, machines, fetched_at), changed, transitions
@@ -0,0 +1,140 @@
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import redis
+import redis.asyncio as aioredis
+from aiogram.types import CallbackQuery
+
+import metrics, settings
+from logger import setup_logger
+
+# Create logger for throttle
+logger = setup_logger('throttle')
+
+THROTTLED = metrics.Counter('bot_throttled_total', 'Requests refused by a token bucket.', ('command', 'scope'))
+
+class Limit(NamedTuple):
+    rate: float  # tokens per second
+    burst: int
+
+
+def parse_limit(value: str) -> Limit:
+    """``"0.5/3"`` -> Limit(rate=0.5, burst=3)."""
+    rate, burst = value.split("/", 1)
+    return Limit(float(rate), int(burst))
+
+
+def parse_limits(value: str) -> Dict[str, Limit]:
+    """``"status=0.5/3,pin=1/5"`` -> {command: Limit}."""
+    return {
+        command: parse_limit(limit)
+        for command, limit in (item.split("=", 1) for item in value.replace(" ", "").split(",") if "=" in item)
+    }
+
+
+def command_name(event: Any) -> str:
+    """``status`` for ``/status@bot 1``, the callback prefix (``pin``) for button presses, ``text`` otherwise."""
+    if isinstance(event, CallbackQuery):
+        return (event.data or "").split(":", 1)[0][:16] or "callback"
+    text = getattr(event, "text", None)
+    if text and text.startswith("/"):
+        return text.split()[0].split("@")[0][1:33]
+    return "text"
+
+
+class TokenBuckets:
+    """Token buckets kept in Redis hashes, so the limits hold across all bot workers.
+
+    One request takes a token from up to three buckets at once: the user's, the user's for this
+    command and the command's across all users. It is refused unless every bucket has a token,
+    and then nothing is taken.
+    """
+
+    # KEYS: buckets; ARGV: rate and burst of each bucket. Buckets refill at ``rate`` tokens per
+    # second up to ``burst``. Returns {0, 0} when allowed, else {bucket index, ms until a token}.
+    SCRIPT = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+        local levels = {}
+        for i, key in ipairs(KEYS) do
+            local rate, burst = tonumber(ARGV[2 * i - 1]) / 1000, tonumber(ARGV[2 * i])
+            local state = redis.call('HMGET', key, 'tokens', 'ts')
+            local tokens = tonumber(state[1]) or burst
+            local ts = tonumber(state[2]) or now
+            tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+            if tokens < 1 then
+                return {i, math.ceil((1 - tokens) / rate)}
+            end
+            levels[i] = tokens
+        end
+        for i, key in ipairs(KEYS) do
+            local rate, burst = tonumber(ARGV[2 * i - 1]) / 1000, tonumber(ARGV[2 * i])
+            redis.call('HSET', key, 'tokens', levels[i] - 1, 'ts', now)
+            redis.call('PEXPIRE', key, math.ceil(burst / rate) + 1000)
+        end
+        return {0, 0}
+    """
+
+    def __init__(self, redis_db: aioredis.Redis, user_limit: Optional[Limit] = None,
+                 command_limits: Optional[Dict[str, Limit]] = None, global_limits: Optional[Dict[str, Limit]] = None):
+        self.user_limit = user_limit if user_limit is not None else parse_limit(settings.THROTTLE_USER)
+        self.command_limits = command_limits if command_limits is not None else parse_limits(settings.THROTTLE_COMMANDS)
+        self.global_limits = global_limits if global_limits is not None else parse_limits(settings.THROTTLE_GLOBAL)
+        self._take = redis_db.register_script(self.SCRIPT)
+
+    def buckets(self, user_id: int, command: str) -> List[Tuple[str, str, Limit]]:
+        """(scope, key, limit) of every bucket a request of ``user_id`` for ``command`` draws from."""
+        buckets = [("user", f'wash_throttle:{user_id}', self.user_limit)]
+        if command in self.command_limits:
+            buckets.append(("command", f'wash_throttle:{user_id}:{command}', self.command_limits[command]))
+        if command in self.global_limits:
+            buckets.append(("global", f'wash_throttle:*:{command}', self.global_limits[command]))
+        return buckets
+
+    def label(self, command: str) -> str:
+        """Metric label of ``command``: anybody can type ``/anything``, so unknown commands share one."""
+        if command in self.command_limits or command in self.global_limits or command in ("text", "callback"):
+            return command
+        return "other"
+
+    async def take(self, user_id: int, command: str) -> Optional[Tuple[str, float]]:
+        """Take a token; returns None when allowed, else the limiting scope and seconds to wait."""
+        buckets = self.buckets(user_id, command)
+        args = []
+        for _, _, limit in buckets:
+            args += [limit.rate, limit.burst]
+        index, wait_ms = await self._take(keys=[key for _, key, _ in buckets], args=args)
+        if not index:
+            return None
+        return buckets[int(index) - 1][0], int(wait_ms) / 1000
+
+
+def middleware(redis_db: aioredis.Redis) -> Callable[..., Awaitable[Any]]:
+    """aiogram outer middleware refusing messages and button presses beyond the token buckets.
+
+    Refused messages are dropped silently; refused button presses only get the cheap
+    ``answerCallbackQuery`` toast, which Telegram needs to stop the button spinner anyway.
+    The admin is never throttled, and without Redis nobody is.
+    """
+    buckets = TokenBuckets(redis_db)
+
+    async def throttle(handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None or user.id == settings.ADMIN_ID:
+            return await handler(event, data)
+        command = command_name(event)
+        try:
+            refused = await buckets.take(user.id, command)
+        except redis.RedisError as e:
+            logger.error(f"Could not check the rate limit of user {user.id}: {str(e)}")
+            return await handler(event, data)
+        if refused is None:
+            return await handler(event, data)
+        scope, wait = refused
+        THROTTLED.inc(buckets.label(command), scope)
+        logger.info(f"Throttled {command} of user {user.id} ({scope} limit), retry in {wait:.1f}s")
+        if isinstance(event, CallbackQuery):
+            await event.answer(f"Слишком часто, попробуйте через {max(1, round(wait))} с")
+        return None
+
+    return throttle
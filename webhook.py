@@ -0,0 +1,200 @@
+import asyncio, multiprocessing, os, signal, time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import redis
+import redis.asyncio as aioredis
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+import metrics, settings
+from logger import setup_logger
+
+# Create logger for webhook
+logger = setup_logger('webhook')
+
+# Pause between two worker restarts of a rolling restart, seconds
+RESTART_DELAY = 5
+# How long a stopping worker may finish its requests before it is killed, seconds
+STOP_TIMEOUT = 30
+
+DUPLICATE_UPDATES = metrics.Counter('bot_duplicate_updates_total',
+                                    'Updates dropped because another worker already handled them.')
+
+
+def update_key(update_id: int) -> str:
+    return f'wash_update:{update_id}'
+
+
+def dedup_middleware(redis_db: aioredis.Redis) -> Callable[..., Awaitable[Any]]:
+    """aiogram outer update middleware handling every ``update_id`` once across all workers.
+
+    The update is claimed with SET NX for ``UPDATE_CLAIM_TTL`` seconds, so a redelivery that reaches
+    another worker while it is handled is dropped. Once handled it is remembered for
+    ``UPDATE_DEDUP_TTL`` seconds; a failed update, or the claim of a worker killed mid update, is
+    released so that Telegram's retry is handled. Without Redis the update is handled anyway.
+    """
+
+    async def middleware(handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+                         event: Update, data: Dict[str, Any]) -> Any:
+        key = update_key(event.update_id)
+        try:
+            claimed = await redis_db.set(key, 'claimed', nx=True, ex=settings.UPDATE_CLAIM_TTL)
+        except redis.RedisError as e:
+            logger.error(f"Could not claim update {event.update_id}, handling it anyway: {str(e)}")
+            return await handler(event, data)
+        if not claimed:
+            DUPLICATE_UPDATES.inc()
+            logger.info(f"Dropping duplicate update {event.update_id}")
+            return None
+        try:
+            result = await handler(event, data)
+        except BaseException:
+            try:
+                await redis_db.delete(key)
+            except redis.RedisError as e:
+                logger.error(f"Could not release update {event.update_id}: {str(e)}")
+            raise
+        try:
+            await redis_db.set(key, 'done', ex=settings.UPDATE_DEDUP_TTL)
+        except redis.RedisError as e:
+            logger.error(f"Could not mark update {event.update_id} as handled: {str(e)}")
+        return result
+
+    return middleware
+
+
+def webhook_url() -> str:
+    return settings.WEBHOOK_URL.rstrip('/') + settings.WEBHOOK_PATH
+
+
+async def register(bot: Bot, dp: Dispatcher) -> None:
+    """Point Telegram at ``WEBHOOK_URL``; done once by the supervisor, not by every worker."""
+    if not settings.WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL must be set in webhook mode")
+    try:
+        await bot.set_webhook(
+            webhook_url(),
+            secret_token=settings.WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+        )
+    finally:
+        await bot.session.close()
+    logger.info(f"Webhook registered at {webhook_url()}")
+
+
+async def serve(dp: Dispatcher, bot: Bot) -> None:
+    """Run one webhook worker until SIGTERM or SIGINT.
+
+    Updates are answered only once they are handled, so Telegram retries those a dying worker
+    could not finish. The socket is bound with SO_REUSEPORT, the kernel spreads the connections
+    between all workers listening on the port.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=settings.WEBHOOK_SECRET or None, handle_in_background=False,
+    ).register(app, path=settings.WEBHOOK_PATH)
+    # Dispatcher startup and shutdown hooks run with the application
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, access_log=None, shutdown_timeout=STOP_TIMEOUT)
+    await runner.setup()
+    await web.TCPSite(runner, settings.WEBHOOK_HOST, settings.WEBHOOK_PORT, reuse_port=True).start()
+    logger.info(f"Webhook worker {os.getpid()} serving {settings.WEBHOOK_HOST}:{settings.WEBHOOK_PORT}"
+                f"{settings.WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logger.info(f"Webhook worker {os.getpid()} stopping")
+        await runner.cleanup()
+
+
+class _Workers:
+    """Spawned webhook workers, restarted when they die and one at a time on SIGHUP."""
+
+    def __init__(self, target: Callable[[], None], count: int):
+        self.target = target
+        self.count = count
+        self.context = multiprocessing.get_context('spawn')
+        self.processes: List[Optional[multiprocessing.process.BaseProcess]] = [None] * count
+        self.process_name = os.path.basename(settings.LOG_DIR)
+
+    def start(self, index: int) -> None:
+        # Spawned interpreters read their settings from the environment they inherit
+        os.environ['LOG_PROCESS'] = f'{self.process_name}-{index}'
+        if settings.METRICS_PORT:
+            os.environ['METRICS_PORT'] = str(settings.METRICS_PORT + index)
+        process = self.context.Process(target=self.target, name=f'webhook-{index}')
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Started webhook worker {index} (pid {process.pid})")
+
+    def stop(self, index: int) -> None:
+        process = self.processes[index]
+        if process is None:
+            return
+        process.terminate()
+        process.join(STOP_TIMEOUT + RESTART_DELAY)
+        if process.is_alive():
+            logger.warning(f"Webhook worker {index} (pid {process.pid}) did not stop, killing it")
+            process.kill()
+            process.join()
+        self.processes[index] = None
+
+    def restart_dead(self) -> None:
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"Webhook worker {index} (pid {process.pid}) exited with {process.exitcode}")
+                self.start(index)
+
+    def rolling_restart(self) -> None:
+        logger.info("Rolling restart of webhook workers")
+        for index in range(self.count):
+            self.stop(index)
+            self.start(index)
+            time.sleep(RESTART_DELAY)
+
+
+def run_workers(target: Callable[[], None], bot: Bot, dp: Dispatcher) -> None:
+    """Register the webhook, then supervise ``WEBHOOK_WORKERS`` processes running ``target``.
+
+    ``target`` must be a module level function of the ``__main__`` module that calls ``serve``.
+    SIGHUP restarts the workers one by one, picking up new code while the others keep serving.
+    """
+    asyncio.run(register(bot, dp))
+    workers = _Workers(target, max(1, settings.WEBHOOK_WORKERS))
+    for index in range(workers.count):
+        workers.start(index)
+
+    signals = {'stop': False, 'restart': False}
+
+    def request_stop(*_: Any) -> None:
+        signals['stop'] = True
+
+    def request_restart(*_: Any) -> None:
+        signals['restart'] = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGHUP, request_restart)
+    try:
+        while not signals['stop']:
+            if signals['restart']:
+                signals['restart'] = False
+                workers.rolling_restart()
+            workers.restart_dead()
+            time.sleep(1)
+    finally:
+        logger.info("Stopping webhook workers")
+        for process in workers.processes:
+            if process is not None:
+                process.terminate()
+        for index in range(workers.count):
+            workers.stop(index)